@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of ydiff alignment and renderers
+
+Usage: tests/benchmark.py [diff file ...]
+
+Input diffs (default: all tests/*/in.diff and tests/large-hunk/tao.diff) are
+parsed and aligned once by Hunk.rows(), then each renderer consumes the same
+rows, so time of a renderer does not include alignment.  The number of line
+pairs compared stays the same after rendering, i.e. no renderer aligns
+again.
+
+Counting lines of each file for --stat is timed next to parsing, as it
+reads the same input without decoding or keeping hunk lines.
+
+Coalescing escapes of the ansi side-by-side output (--compact-ansi) is
+timed, with its size before and after.
+
+Alignment of a vendored directory, i.e. new files of only added lines, is
+timed with the one-sided fast path of Hunk.rows() and through difflib.
+
+Side-by-side rendering of a generated brace-heavy Java diff is timed with
+and without the memo of rendered common lines.
+
+A single file of many hunks of changed lines is aligned and rendered side by
+side in one process and in a pool of 4 (--render-jobs), speedup depends on
+cores of the host.  A diff of 10 such files, smaller, is rendered in a pool
+of 4 processes and of 4 threads (--threads), which only scale on a
+free-threaded Python.
+
+Lines of a file of 20000 lines, shuffled in blocks of 20 lines and edited,
+are matched by each --diff-algorithm, the number of lines matched tells
+the quality.
+
+Reading lines from a pipe is timed with the input repeated 100 times, with
+default buffering and with the stream ydiff reads revision control from,
+and gzip compressed through `zcat` and decompressed by ydiff in a thread.
+"""
+
+import collections
+import glob
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SELF_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SELF_DIR, '..'))
+import ydiff  # nopep8
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _consume(lines):
+    for _ in lines:
+        pass
+
+
+def _read_pipe(cmd):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    _consume(proc.stdout)
+    proc.wait()
+
+
+def _read_stream(cmd):
+    stream = ydiff._ProcessStream(cmd)
+    _consume(stream)
+    stream.close()
+
+
+def _read_decompressed(path):
+    stream = ydiff._open_compressed(path)
+    _consume(stream)
+    stream.close()
+
+
+def _vendored_diff(files=200, lines=500):
+    stream = []
+    for i in range(files):
+        stream.extend([
+            b'diff --git a/vendor/f%d.py b/vendor/f%d.py\n' % (i, i),
+            b'new file mode 100644\n',
+            b'--- /dev/null\n',
+            b'+++ b/vendor/f%d.py\n' % i,
+            b'@@ -0,0 +1,%d @@\n' % lines,
+        ])
+        stream.extend(b'+    value_%d = compute(%d, %d)\n' % (j, i, j)
+                      for j in range(lines))
+    return stream
+
+
+def _braces_diff(hunks=2000):
+    stream = [b'--- a/Main.java\n', b'+++ b/Main.java\n']
+    for i in range(hunks):
+        stream.extend([
+            b'@@ -%d,12 +%d,12 @@ class Main {\n' % (i * 20 + 1, i * 20 + 1),
+            b'         }\n',
+            b'     }\n',
+            b' \n',
+            b'     @Override\n',
+            b'     public int method%d(int x) {\n' % i,
+            b'-        return x + %d;\n' % i,
+            b'+        return x * %d;\n' % i,
+            b'         if (x > 0) {\n',
+            b'             x--;\n',
+            b'         }\n',
+            b'     }\n',
+            b' \n',
+        ])
+    return stream
+
+
+def _hunks_diff(hunks=400, lines=10, files=1):
+    stream = []
+    for i in range(hunks * files):
+        if i % hunks == 0:
+            stream.extend([b'--- a/schema%d.sql\n' % (i // hunks),
+                           b'+++ b/schema%d.sql\n' % (i // hunks)])
+        start = i * (lines + 10) + 1
+        stream.append(b'@@ -%d,%d +%d,%d @@\n' % (start, lines, start, lines))
+        stream.extend(b'-  column_%d_%d INTEGER NOT NULL,\n' % (i, j)
+                      for j in range(lines))
+        stream.extend(b'+  column_%d_%d BIGINT NOT NULL,\n' % (i, j)
+                      for j in range(lines))
+    return stream
+
+
+def _moved_blocks(lines=20000, size=20):
+    rand = random.Random(1)
+    a = ['line %d\n' % i for i in range(lines)]
+    blocks = [a[i:i + size] for i in range(0, lines, size)]
+    rand.shuffle(blocks)
+    b = [line for block in blocks for line in block]
+    for _ in range(lines // 50):
+        i = rand.randrange(lines)
+        b[i] = 'edit %d\n' % i
+    return a, b
+
+
+def _mdiff_rows(hunks):
+    # Whole hunk through difflib, as before one-sided and segmented paths
+    for hunk in hunks:
+        _consume(ydiff._mdiff(hunk._get_old_text(), hunk._get_new_text(),
+                              ydiff._LineDiffer()))
+
+
+def main(paths):
+    stream = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            stream.extend(f.readlines())
+
+    diffs = []
+    stats = collections.Counter()
+    results = [
+        ('parse', _timed(
+            lambda: diffs.extend(ydiff.DiffParser(stream).parse()))),
+        ('stat', _timed(lambda: _consume(ydiff._diffstat(stream)))),
+        ('align', _timed(
+            lambda: [h.rows(0.75, stats) for d in diffs for h in d._hunks])),
+    ]
+    pairs = stats['pair.candidates']
+
+    # Hunk render cache is off to time rendering of every hunk
+    renderers = [
+        ('ansi unified', ydiff.DiffMarker(stats=stats, cache_size=0)),
+        ('ansi side-by-side', ydiff.DiffMarker(
+            side_by_side=True, width=80, wrap=True, stats=stats,
+            cache_size=0)),
+        ('text side-by-side', ydiff.DiffMarker(
+            side_by_side=True, width=80, wrap=True, stats=stats,
+            cache_size=0, color=False)),
+        ('html side-by-side', ydiff.HtmlMarker(
+            side_by_side=True, stats=stats, cache_size=0)),
+    ]
+    for name, marker in renderers:
+        results.append((name, _timed(lambda: _consume(
+            line for d in diffs for line in marker.markup(d)))))
+    marker = ydiff.DiffMarker(side_by_side=True, width=80, wrap=True,
+                              cache_size=0)
+    ansi = [line for d in diffs for line in marker.markup(d)]
+    compact = []
+    results.append(('compact ansi', _timed(
+        lambda: compact.extend(ydiff._compact_ansi(ansi)))))
+    results.append(('jsonl', _timed(lambda: _consume(
+        json.dumps(r) for r in ydiff._records(diffs, 0.75, stats)))))
+
+    vendored = [h for d in ydiff.DiffParser(_vendored_diff()).parse()
+                for h in d._hunks]
+    results.append(('align vendored', _timed(
+        lambda: [h.rows() for h in vendored])))
+    results.append(('align vendored (difflib)', _timed(
+        lambda: _mdiff_rows(vendored))))
+
+    braces = list(ydiff.DiffParser(_braces_diff()).parse())
+    _consume(h.rows() for d in braces for h in d._hunks)
+    for name, memo in (('braces side-by-side', True),
+                       ('braces (no memo)', False)):
+        marker = ydiff.DiffMarker(side_by_side=True, width=80, wrap=True,
+                                  stats=stats, cache_size=0, generated=None)
+        if not memo:
+            marker._fragments = None
+        results.append((name, _timed(lambda: _consume(
+            line for d in braces for line in marker.markup(d)))))
+
+    for jobs in (1, 4):
+        marker = ydiff.DiffMarker(side_by_side=True, width=80, wrap=True,
+                                  cache_size=0, generated=None, jobs=jobs)
+        # Parsed again, so that alignment is timed as well
+        schema = list(ydiff.DiffParser(_hunks_diff()).parse())
+        results.append(('render 1 file (jobs=%d)' % jobs, _timed(
+            lambda: _consume(line for d in schema
+                             for line in marker.markup(d)))))
+        marker.close()
+    for name, threads in (('processes', False), ('threads', True)):
+        marker = ydiff.DiffMarker(side_by_side=True, width=80, wrap=True,
+                                  cache_size=0, generated=None, jobs=4,
+                                  threads=threads)
+        schema = list(ydiff.DiffParser(_hunks_diff(20, files=10)).parse())
+        results.append(('render 10 files (4 %s)' % name, _timed(
+            lambda: _consume(line for d in schema
+                             for line in marker.markup(d)))))
+        marker.close()
+
+    a, b = _moved_blocks()
+    matched = []
+    for algorithm in ydiff._ALGORITHMS:
+        matcher = ydiff._line_matcher(a, b, algorithm)
+        results.append(('match moved (%s)' % algorithm,
+                        _timed(matcher.get_opcodes)))
+        matched.append('%s %d' % (algorithm, sum(
+            n for _, _, n in matcher.get_matching_blocks())))
+
+    cmd = ['cat'] + paths * 100
+    results.append(('read (default)', _timed(lambda: _read_pipe(cmd))))
+    results.append(('read (ydiff)', _timed(lambda: _read_stream(cmd))))
+    with tempfile.NamedTemporaryFile(suffix='.gz') as packed:
+        packed.write(gzip.compress(b''.join(stream) * 100))
+        packed.flush()
+        results.append(('read gzip (zcat)', _timed(
+            lambda: _read_pipe(['zcat', packed.name]))))
+        results.append(('read gzip (ydiff)', _timed(
+            lambda: _read_decompressed(packed.name))))
+
+    lines = sum(len(h._hunk_list) for d in diffs for h in d._hunks)
+    print('%d diffs, %d hunk lines, GIL %s' % (
+        len(diffs), lines, 'on' if ydiff._gil_enabled() else 'off'))
+    for name, seconds in results:
+        print('%-30s %8.3fs' % (name, seconds))
+    print('ansi side-by-side: %d chars, %d compacted' % (
+        sum(map(len, ansi)), sum(map(len, compact))))
+    print('lines of moved blocks matched: %s' % ', '.join(matched))
+    print('line pairs compared: %d after align, %d after rendering' %
+          (pairs, stats['pair.candidates']))
+    return 0 if pairs == stats['pair.candidates'] else 1
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or (sorted(glob.glob(os.path.join(SELF_DIR,
+                                                           '*/in.diff'))) +
+                             [os.path.join(SELF_DIR, 'large-hunk/tao.diff')])
+    sys.exit(main(paths))
+
+# vim:set et sts=4 sw=4 tw=79:
@@ -3,10 +3,27 @@
 
 """Unit test for ydiff"""
 
+import bz2
+import collections
+import difflib
+import errno
+import gc
+import glob
+import gzip
+import io
+import json
+import lzma
+import random
+import re
+import signal
+import string
 import sys
 import unittest
+import unittest.mock
 import tempfile
+import threading
 import subprocess
+import time
 import os
 
 sys.path.insert(0, '')
@@ -128,6 +145,94 @@ class DecodeTest(unittest.TestCase):
         self.assertEqual(ydiff._decode(octets), want)
 
 
+class MdiffTest(unittest.TestCase):
+
+    def _random_lines(self, rand, n):
+        words = ['foo', 'bar', 'baz', 'spam', 'eggs', '(', ')', ' ', '\t']
+        return [''.join(rand.choice(words) for _ in range(rand.randint(0, 8)))
+                + '\n' for _ in range(n)]
+
+    def test_same_as_difflib(self):
+        rand = random.Random(42)
+        for _ in range(200):
+            a = self._random_lines(rand, rand.randint(0, 12))
+            b = a[:]
+            for _ in range(rand.randint(1, 6)):
+                i = rand.randint(0, len(b))
+                b[i:i + rand.randint(0, 2)] = self._random_lines(
+                    rand, rand.randint(0, 2))
+            want = list(difflib._mdiff(a, b))
+            got = list(ydiff._mdiff(a, b, ydiff._LineDiffer()))
+            self.assertEqual(want, got)
+
+    def test_similarity(self):
+        a = ['import foo\n']
+        b = ['import bar\n']
+        rows = list(ydiff._mdiff(a, b, ydiff._LineDiffer(0.75)))
+        self.assertEqual(rows[0][0], (1, '\0-import foo\n\1'))
+        self.assertEqual(rows[0][1], (1, '\0+import bar\n\1'))
+        rows = list(ydiff._mdiff(a, b, ydiff._LineDiffer(0.6)))
+        self.assertEqual(rows[0][0], (1, 'import \0^foo\1\n'))
+        self.assertEqual(rows[0][1], (1, 'import \0^bar\1\n'))
+
+    def test_pruning_stats(self):
+        rand = random.Random(42)
+        a = self._random_lines(rand, 150)
+        b = [''.join(rand.choice(string.ascii_letters)
+                     for _ in range(rand.randint(10, 30))) + '\n'
+             for _ in range(150)]
+        stats = collections.Counter()
+        rows = list(ydiff._mdiff(a, b, ydiff._LineDiffer(stats=stats)))
+        self.assertEqual(len([r for r in rows if r[0][0]]), 150)
+        self.assertEqual(len([r for r in rows if r[1][0]]), 150)
+
+        pruned = sum(v for k, v in stats.items()
+                     if k.startswith('pair.pruned_by_'))
+        self.assertGreater(stats['pair.pruned_by_length'], 0)
+        self.assertGreater(stats['pair.pruned_by_sketch'], 0)
+        self.assertEqual(stats['pair.candidates'],
+                         pruned + stats['pair.ratio_computed'])
+
+    def test_anchored_algorithms(self):
+        rand = random.Random(42)
+        words = ['{\n', '}\n', '\n', 'foo\n']
+        words += ['u%d\n' % i for i in range(30)]
+        for algorithm in ('patience', 'histogram'):
+            for _ in range(200):
+                a = [rand.choice(words) for _ in range(rand.randint(0, 40))]
+                b = a[:]
+                for _ in range(rand.randint(1, 4)):
+                    i = rand.randint(0, len(b))
+                    j = rand.randint(0, len(b))
+                    b[i:i + rand.randint(0, 5)] = b[j:j + rand.randint(0, 5)]
+                blocks = ydiff._anchored_blocks(a, b, algorithm)
+                self.assertEqual(blocks[-1], (len(a), len(b), 0))
+                i0 = j0 = 0
+                for i, j, n in blocks:
+                    self.assertTrue(i >= i0 and j >= j0)
+                    self.assertEqual(a[i:i + n], b[j:j + n])
+                    i0, j0 = i + n, j + n
+                differ = ydiff._LineDiffer(algorithm=algorithm)
+                lines = list(differ.compare(a, b))
+                self.assertEqual(list(difflib.restore(lines, 1)), a)
+                self.assertEqual(list(difflib.restore(lines, 2)), b)
+
+    def test_patience(self):
+        # Bram Cohen's example, difflib matches the new function's braces
+        a = ['#include <stdio.h>\n', '\n', '// Frobs foo heartily\n',
+             'int frobnitz(int foo)\n', '{\n', '    int i;\n', '}\n', '\n',
+             'int fact(int n)\n', '{\n', '    return 1;\n', '}\n']
+        b = ['#include <stdio.h>\n', '\n', 'int fib(int n)\n', '{\n',
+             '    return 1;\n', '}\n', '\n', '// Frobs foo heartily\n',
+             'int frobnitz(int foo)\n', '{\n', '    int i;\n', '}\n']
+        matcher = ydiff._line_matcher(a, b, 'difflib')
+        self.assertEqual(matcher.get_opcodes()[1], ('insert', 1, 1, 1, 6))
+        for algorithm in ('patience', 'histogram'):
+            matcher = ydiff._line_matcher(a, b, algorithm)
+            self.assertEqual(matcher.get_opcodes()[:2], [
+                ('equal', 0, 2, 0, 2), ('insert', 2, 2, 2, 7)])
+
+
 class HunkTest(unittest.TestCase):
 
     def test_get_old_text(self):
@@ -144,6 +249,125 @@ class HunkTest(unittest.TestCase):
         hunk.append((' ', 'common\n'))
         self.assertEqual(hunk._get_new_text(), ['bar\n', 'common\n'])
 
+    def test_rows(self):
+        hunk = ydiff.Hunk([], '@@ -1,3 +1,3 @@', (1, 3), (1, 3))
+        hunk.append(('-', 'import foo\n'))
+        hunk.append(('-', 'gone\n'))
+        hunk.append(('+', 'import bar\n'))
+        hunk.append((' ', 'common\n'))
+        hunk.append(('+', 'new\n'))
+        rows = hunk.rows()
+        self.assertEqual(
+            [(r.old_num, r.new_num, r.kind, r.old_text, r.new_text)
+             for r in rows],
+            [(1, 1, 'changed', 'import foo\n', 'import bar\n'),
+             (2, '', 'old', 'gone\n', ''),
+             (3, 2, 'common', 'common\n', 'common\n'),
+             ('', 3, 'new', '', 'new\n')])
+        self.assertEqual(rows[0].word_diff(),
+                         ('import \0^foo\1\n', 'import \0^bar\1\n'))
+        self.assertEqual(rows[0].word_diff(str.upper),
+                         ('IMPORT \0^FOO\1\n', 'IMPORT \0^BAR\1\n'))
+
+        # Aligned once for each similarity
+        self.assertIs(hunk.rows(), rows)
+        self.assertIsNot(hunk.rows(0.6), rows)
+
+    def test_rows_keep_common_lines(self):
+        # difflib on the whole hunk would pair the first common line with
+        # the added blank line
+        hunk = ydiff.Hunk([], '@@ -1,5 +1,6 @@', (1, 5), (1, 6))
+        hunk.append((' ', '\n'))
+        hunk.append(('+', 'x\n'))
+        hunk.append(('+', '\n'))
+        hunk.append((' ', 'y\n'))
+        hunk.append(('-', 'foo = 1\n'))
+        hunk.append(('+', 'foo = 2\n'))
+        hunk.append((' ', 'z\n'))
+        hunk.append(('-', 'gone\n'))
+        with unittest.mock.patch('ydiff._mdiff',
+                                 wraps=ydiff._mdiff) as mdiff:
+            rows = hunk.rows()
+        # Only the change block of both sides is aligned
+        self.assertEqual(mdiff.call_count, 1)
+        self.assertEqual(mdiff.call_args[0][:2],
+                         (['foo = 1\n'], ['foo = 2\n']))
+        self.assertEqual(
+            [(r.old_num, r.new_num, r.kind) for r in rows],
+            [(1, 1, 'common'), ('', 2, 'new'), ('', 3, 'new'),
+             (2, 4, 'common'), (3, 5, 'changed'), (4, 6, 'common'),
+             (5, '', 'old')])
+
+    def test_rows_one_sided(self):
+        stats = collections.Counter()
+        hunk = ydiff.Hunk([], '@@ -0,0 +1,2 @@', (0, 0), (1, 2))
+        hunk.append(('+', 'foo\n'))
+        self.assertFalse(hunk.is_completed())
+        hunk.append(('+', ''))
+        self.assertTrue(hunk.is_completed())
+        self.assertTrue(hunk.is_one_sided())
+        with unittest.mock.patch('ydiff._mdiff') as mdiff:
+            rows = hunk.rows(stats=stats)
+        self.assertFalse(mdiff.called)
+        self.assertEqual(
+            [(r.old_num, r.new_num, r.kind, r.old_text, r.new_text)
+             for r in rows],
+            [('', 1, 'new', '', 'foo\n'),
+             ('', 2, 'new', '', ' ')])
+        self.assertEqual(stats, {'hunk.one_sided': 1})
+
+        hunk = ydiff.Hunk([], '@@ -1,2 +1 @@', (1, 2), (1, 1))
+        hunk.append(('-', 'foo\n'))
+        hunk.append((' ', 'bar\n'))
+        self.assertFalse(hunk.is_one_sided())
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evict(self):
+        stats = collections.Counter()
+        cache = ydiff._LRUCache(4, stats, 'test')
+        cache.put('a', 'A', 2)
+        cache.put('b', 'B', 2)
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('c', 'C', 1)     # evicts least recently used 'b'
+        self.assertIsNone(cache.get('b'))
+        cache.put('d', 'D', 5)     # too large to cache
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(stats, {'test.hits': 3, 'test.misses': 2,
+                                 'test.evictions': 1})
+
+
+class TerminalTest(unittest.TestCase):
+
+    def test_width(self):
+        size = os.terminal_size((100, 40))
+        with unittest.mock.patch('shutil.get_terminal_size',
+                                 return_value=size) as get_size:
+            terminal = ydiff._Terminal()
+            self.assertEqual(terminal.width(), 100)
+            self.assertEqual(terminal.width(), 100)
+            self.assertEqual(get_size.call_count, 1)
+
+            get_size.return_value = os.terminal_size((120, 40))
+            terminal.resized()
+            self.assertEqual(terminal.width(), 120)
+            self.assertEqual(get_size.call_count, 2)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGWINCH'), 'no SIGWINCH')
+    def test_watch(self):
+        handler = signal.getsignal(signal.SIGWINCH)
+        try:
+            terminal = ydiff._Terminal()
+            terminal._width = 1
+            terminal.watch()
+            os.kill(os.getpid(), signal.SIGWINCH)
+            self.assertIsNone(terminal._width)
+        finally:
+            signal.signal(signal.SIGWINCH, handler)
+
 
 class DiffMarkupTest(unittest.TestCase):
 
@@ -498,6 +722,230 @@ class DiffMarkupTest(unittest.TestCase):
             '\x1b[0m\x1b[33m5\x1b[0m '
             '\x1b[32m \x1b[7m\x1b[32mspaced\x1b[0m\x1b[32m\x1b[0m\n')
 
+    def test_markup_repeated_hunk(self):
+        diff = self._init_diff()
+        hunk = diff._hunks[0]
+        again = ydiff.Hunk([], '@@ -21,5 +101,5 @@\n', (21, 5), (101, 5))
+        for hunk_line in hunk._hunk_list:
+            again.append(hunk_line)
+        diff._hunks.append(again)
+        for side_by_side in (False, True):
+            stats = collections.Counter()
+            marker = ydiff.DiffMarker(side_by_side=side_by_side, width=4,
+                                      wrap=True, stats=stats)
+            uncached = ydiff.DiffMarker(side_by_side=side_by_side, width=4,
+                                        wrap=True, cache_size=0)
+            out = list(marker.markup(diff))
+            self.assertEqual(out, list(uncached.markup(diff)))
+            self.assertEqual(stats['hunk_cache.misses'], 1)
+            self.assertEqual(stats['hunk_cache.hits'], 1)
+        # Line numbers are from the second hunk's address
+        self.assertIn('\x1b[33m 25\x1b[0m ', ''.join(out))
+        self.assertIn('\x1b[33m105\x1b[0m ', ''.join(out))
+
+    def test_markup_side_by_side_no_color(self):
+        diff = self._init_diff()
+        marker = ydiff.DiffMarker(side_by_side=True, width=7, color=False)
+        out = list(marker.markup(diff))
+        self.assertEqual(out[:5], ['header\n', '--- old\n', '+++ new\n',
+                                   'hunk header\n', '@@ -1,5 +1,5 @@\n'])
+        self.assertEqual(out[5:], [
+            '1 _hello  1 hello+\n',
+            '          2 spammm\n',
+            '2 world   3 world\n',
+            '3 garb   \n',
+            '4 Again   4 again\n',
+            '5       > 5  spaced\n',
+        ])
+
+    def test_markup_side_by_side_common_memo(self):
+        hunk = ydiff.Hunk([], '@@ -1,7 +1,7 @@\n', (1, 7), (1, 7))
+        for attr, text in [(' ', '}\n'), ('-', 'foo\n'), ('+', 'bar\n'),
+                           (' ', '}\n'), (' ', '\tx\n'), (' ', '}\n'),
+                           (' ', 'x' * 100 + '\n'), (' ', '}\n')]:
+            hunk.append((attr, text))
+        diff = ydiff.UnifiedDiff([], '--- a\n', '+++ b\n', [hunk])
+        for wrap in (False, True):
+            stats = collections.Counter()
+            marker = ydiff.DiffMarker(side_by_side=True, width=20, wrap=wrap,
+                                      stats=stats, cache_size=0)
+            plain = ydiff.DiffMarker(side_by_side=True, width=20, wrap=wrap,
+                                     cache_size=0)
+            plain._fragments = None
+            self.assertEqual(list(marker.markup(diff)),
+                             list(plain.markup(diff)))
+            # Long line is not memoized
+            self.assertEqual(stats['fragment_cache.misses'], 2)
+            self.assertEqual(stats['fragment_cache.hits'], 3)
+
+    def test_markup_render_jobs(self):
+        def diff():
+            hunks = [self._init_diff()._hunks[0] for _ in range(5)]
+            return ydiff.UnifiedDiff(['header\n'], '--- old\n', '+++ new\n',
+                                     hunks)
+
+        for marker_class, side_by_side, threads in [
+                (ydiff.DiffMarker, False, False),
+                (ydiff.DiffMarker, True, False),
+                (ydiff.HtmlMarker, True, False),
+                (ydiff.DiffMarker, True, True),
+                (ydiff.HtmlMarker, False, True)]:
+            # Each worker has its own cache of rendered hunks
+            want_stats = collections.Counter()
+            marker = marker_class(side_by_side=side_by_side, width=20,
+                                  stats=want_stats, cache_size=0)
+            want = list(marker.markup(diff()))
+            stats = collections.Counter()
+            marker = marker_class(side_by_side=side_by_side, width=20,
+                                  stats=stats, cache_size=0, jobs=2,
+                                  threads=threads)
+            try:
+                self.assertEqual(list(marker.markup(diff())), want)
+            finally:
+                marker.close()
+            self.assertEqual(stats['pair.candidates'],
+                             want_stats['pair.candidates'])
+
+    def test_markup_side_by_side_resized(self):
+        class FakeTerminal:
+            columns = 30
+
+            def width(self):
+                return self.columns
+
+        terminal = FakeTerminal()
+        diff = self._init_diff()
+        stats = collections.Counter()
+        marker = ydiff.DiffMarker(side_by_side=True, wrap=True, stats=stats,
+                                  terminal=terminal)
+        out = list(marker.markup(diff))
+        self.assertEqual(out[7], '\x1b[33m2\x1b[0m '
+                                 '\x1b[0mworld\x1b[0m        '
+                                 '\x1b[0m\x1b[33m3\x1b[0m '
+                                 '\x1b[0mworld\x1b[0m\n')
+        rows = diff._hunks[0].rows()
+        candidates = stats['pair.candidates']
+
+        # Wider text, but lines are not aligned again
+        terminal.columns = 40
+        out = list(marker.markup(diff))
+        self.assertEqual(out[7], '\x1b[33m2\x1b[0m '
+                                 '\x1b[0mworld\x1b[0m             '
+                                 '\x1b[0m\x1b[33m3\x1b[0m '
+                                 '\x1b[0mworld\x1b[0m\n')
+        self.assertIs(diff._hunks[0].rows(), rows)
+        self.assertEqual(stats['pair.candidates'], candidates)
+        self.assertEqual(stats['hunk_cache.misses'], 2)
+
+
+class GeneratedTest(unittest.TestCase):
+
+    def _diff(self, path, lines):
+        hunk = ydiff.Hunk([], '@@ -0,0 +1,%d @@\n' % len(lines),
+                          (0, 0), (1, len(lines)))
+        for line in lines:
+            hunk.append(('+', line))
+        return ydiff.UnifiedDiff(['header\n'], '--- /dev/null\n',
+                                 '+++ b/%s\t(rev 1)\n' % path, [hunk])
+
+    def test_is_generated(self):
+        patterns = ydiff._GENERATED_PATHS
+        self.assertFalse(ydiff._is_generated(
+            self._diff('src/app.js', ['x\n']), patterns))
+        self.assertTrue(ydiff._is_generated(
+            self._diff('web/yarn.lock', ['x\n']), patterns))
+        self.assertTrue(ydiff._is_generated(
+            self._diff('dist/app.min.js', ['x\n']), patterns))
+        self.assertTrue(ydiff._is_generated(
+            self._diff('src/app.js', ['x\n']), patterns + ('src/*',)))
+        self.assertTrue(ydiff._is_generated(
+            self._diff('src/app.js', ['x' * 1001 + '\n']), patterns))
+        self.assertTrue(ydiff._is_generated(
+            self._diff('src/app.js', ['x\n'] * 20001), patterns))
+
+    def test_markup_collapsed(self):
+        diff = self._diff('go.sum', ['a\n', 'b\n'])
+        for side_by_side in (False, True):
+            stats = collections.Counter()
+            marker = ydiff.DiffMarker(side_by_side=side_by_side, width=80,
+                                      stats=stats, color=False)
+            self.assertEqual(list(marker.markup(diff)), [
+                'header\n', '--- /dev/null\n', '+++ b/go.sum\t(rev 1)\n',
+                '2 lines changed, rendering skipped\n'])
+            self.assertEqual(stats['diff.collapsed'], 1)
+
+        marker = ydiff.DiffMarker(color=False, generated=None)
+        self.assertEqual(list(marker.markup(diff))[-1], '+b\n')
+
+        out = list(ydiff.HtmlMarker().markup(diff))
+        self.assertEqual(out[-2], '<tr><td colspan="3" class="hm">'
+                                  '2 lines changed, rendering skipped\n')
+        self.assertEqual(out[-1], '</table>\n')
+
+
+class HtmlMarkerTest(unittest.TestCase):
+
+    _init_diff = DiffMarkupTest._init_diff
+
+    def test_css(self):
+        theme = ydiff._THEMES['dark']
+        self.assertEqual(ydiff._css(theme['old_line']),
+                         'background:#5f0000')
+        self.assertEqual(ydiff._css(theme['inserted_text']),
+                         'color:#262626;background:#008700')
+        theme = ydiff._THEMES['default']
+        self.assertEqual(ydiff._css(theme['deleted_text']),
+                         'color:#fff;background:#cd0000')
+        self.assertEqual(ydiff._css(theme['common_line']), '')
+        self.assertIn('\n.rot{color:#fff;background:#cd0000}\n',
+                      ydiff._stylesheet())
+
+    def test_themes_read_only(self):
+        # Shared by rendering threads
+        with self.assertRaises(TypeError):
+            ydiff._THEMES['default']['old_line'] = ['\x1b[35m']
+        with self.assertRaises(AttributeError):
+            ydiff._THEMES['default']['old_line'].append('\x1b[35m')
+
+    def test_markup_side_by_side(self):
+        diff = self._init_diff()
+        diff._hunks[0]._hunk_list[3] = (' ', '<world> & co\n')
+        marker = ydiff.HtmlMarker(side_by_side=True)
+        out = list(marker.markup(diff))
+        self.assertEqual(len(out), 13)
+        self.assertEqual(out[0], '<table class="ydiff ydiff-sbs">\n')
+        self.assertEqual(out[2], '<tr><td colspan="4" class="op">--- old\n')
+        self.assertEqual(
+            out[6],
+            '<tr><th>1<td class="ol"><span class="rot">_</span>hello'
+            '<th>1<td class="nl">hello<span class="rnt">+</span>\n')
+        self.assertEqual(out[7], '<tr><th><td><th>2<td class="nl">spammm\n')
+        self.assertEqual(
+            out[8],
+            '<tr><th>2<td>&lt;world&gt; &amp; co'
+            '<th>3<td>&lt;world&gt; &amp; co\n')
+        self.assertEqual(out[9], '<tr><th>3<td class="ol">garb<th><td>\n')
+        self.assertEqual(
+            out[11],
+            '<tr><th>5<td class="ol"><span class="dt">\ttabbed</span>'
+            '<th>5<td class="nl"><span class="it"> spaced</span>\n')
+        self.assertEqual(out[12], '</table>\n')
+
+    def test_markup_unified(self):
+        diff = self._init_diff()
+        marker = ydiff.HtmlMarker(side_by_side=False)
+        out = list(marker.markup(diff))
+        self.assertEqual(len(out), 16)
+        self.assertEqual(out[0], '<table class="ydiff ydiff-unified">\n')
+        self.assertEqual(
+            out[6], '<tr><th>1<th><td class="ol">-<span class="rot">_</span>'
+            'hello\n')
+        self.assertEqual(
+            out[7], '<tr><th><th>1<td class="nl">+hello'
+            '<span class="rnt">+</span>\n')
+        self.assertEqual(out[8], '<tr><th><th>2<td class="nl">+spammm\n')
+        self.assertEqual(out[9], '<tr><th>2<th>3<td> world\n')
+
 
 class UnifiedDiffTest(unittest.TestCase):
 
@@ -555,6 +1003,74 @@ class UnifiedDiffTest(unittest.TestCase):
 
 class DiffParserTest(unittest.TestCase):
 
+    def test_parse_encoding_per_file(self):
+        patch = (('--- a/caf\u00e9\n'
+                  '+++ b/caf\u00e9\n'
+                  '@@ -1,2 +1,2 @@\n').encode('utf-8') +
+                 ('-cr\u00c3\u00a9me\n'            # valid utf-8 as well
+                  '+cr\u00e8me\n'
+                  ' caf\u00e9\n').encode('latin-1') +
+                 ('--- a/b\n'
+                  '+++ b/b\n'
+                  '@@ -1 +1 @@\n'
+                  '-caf\u00e9\n'
+                  '+\u4f60\u597d\n').encode('utf-8'))
+        diffs = list(ydiff.DiffParser(patch.splitlines(True)).parse())
+        self.assertEqual(diffs[0]._old_path, '--- a/caf\u00e9\n')
+        self.assertEqual(diffs[0]._hunks[0]._hunk_list, [
+            ('-', 'cr\u00c3\u00a9me\n'),
+            ('+', 'cr\u00e8me\n'),
+            (' ', 'caf\u00e9\n')])
+        self.assertEqual(diffs[1]._hunks[0]._hunk_list, [
+            ('-', 'caf\u00e9\n'),
+            ('+', '\u4f60\u597d\n')])
+
+    def test_parse_encoding_not_in_log_message(self):
+        # Indented message of next commit looks like hunk lines
+        patch = (('commit 1\n'
+                  '\n'
+                  '    Add caf\u00e9\n'
+                  '\n'
+                  '--- a/a\n'
+                  '+++ b/a\n'
+                  '@@ -1 +1 @@\n').encode('utf-8') +
+                 ('-a\n'
+                  '+caf\u00e9\n').encode('latin-1') +
+                 ('commit 2\n'
+                  '\n'
+                  '    Fix na\u00efve caf\u00e9\n'
+                  '\n'
+                  '--- a/b\n'
+                  '+++ b/b\n'
+                  '@@ -1 +1 @@\n'
+                  '-b\n'
+                  '+\u00e9\n').encode('utf-8'))
+        diffs = list(ydiff.DiffParser(patch.splitlines(True)).parse())
+        self.assertEqual(diffs[0]._hunks[0]._hunk_list[-1],
+                         ('+', 'caf\u00e9\n'))
+        self.assertEqual(diffs[1]._headers[2],
+                         '    Fix na\u00efve caf\u00e9\n')
+        self.assertEqual(diffs[1]._hunks[0]._hunk_list[-1], ('+', '\u00e9\n'))
+
+    def test_parse_encoding_fallback(self):
+        # Not detected from the first lines, turns latin-1 when seen
+        lines = ['--- a\n', '+++ b\n', '@@ -1,2 +1,2 @@\n', '-a\n', '+b\n',
+                 ' \u00e9\n']
+        patch = b''.join(x.encode('latin-1') for x in lines)
+        parser = ydiff.DiffParser(patch.splitlines(True))
+        with unittest.mock.patch.object(ydiff, '_DETECT_LINES', 1):
+            diffs = list(parser.parse())
+        self.assertEqual(diffs[0]._hunks[0]._hunk_list[-1], (' ', '\u00e9\n'))
+        self.assertEqual(parser._encoding, 'latin-1')
+
+    def test_parse_given_encoding(self):
+        patch = ('--- a\n+++ b\n@@ -1 +1 @@\n-\u043c\u0438\u0440\n'
+                 '+\u043c\u0438\u0440!\n').encode('cp1251')
+        parser = ydiff.DiffParser(patch.splitlines(True), 'cp1251')
+        diffs = list(parser.parse())
+        self.assertEqual(diffs[0]._hunks[0]._hunk_list, [
+            ('-', '\u043c\u0438\u0440\n'), ('+', '\u043c\u0438\u0440!\n')])
+
     def test_parse_invalid_hunk_meta(self):
         patch = b"""\
 spam
@@ -780,6 +1296,865 @@ Added: svn:keywords
         self.assertEqual(hunk._hunk_list, [('+', 'Id\n')])
 
 
+class LogTest(unittest.TestCase):
+
+    def _read_lines(self, name):
+        with open(os.path.join('tests', name, 'in.diff'), 'rb') as f:
+            return f.readlines()
+
+    def test_commit_ids(self):
+        tests = [
+            # (headers, want)
+            (['commit 65f33a326fb1d81e9b56cfa9dbe3af887ed91c8d\n',
+              'Author: me\n'], ['65f33a326fb1d81e9b56cfa9dbe3af887ed91c8d']),
+            (['commit 65f33a3 (HEAD -> master)\n'], ['65f33a3']),
+            (['changeset:   12:a9a87f0e7c50\n', 'user: me\n'],
+             ['a9a87f0e7c50']),
+            (['-' * 72 + '\n', 'r1235 | me | 2011-09-01 | 3 lines\n'],
+             ['r1235']),
+            (['commit a9a87f0e7c50\n', 'commit b0ef6a5a6dcc\n'],
+             ['a9a87f0e7c50', 'b0ef6a5a6dcc']),
+            (['diff --git a/commit b/commit\n', 'index 1eacfd8..3696851\n'],
+             []),
+        ]
+        for headers, want in tests:
+            self.assertEqual(want, ydiff._commit_ids(headers))
+
+    def test_limit_commits_git(self):
+        lines = self._read_lines('git-log')
+        out = list(ydiff._limit_commits(iter(lines), 1))
+        self.assertEqual(out, lines[:19])
+        out = list(ydiff._limit_commits(iter(lines), 2))
+        self.assertEqual(out, lines)
+
+    def test_limit_commits_svn(self):
+        lines = self._read_lines('svn-log')
+        out = list(ydiff._limit_commits(iter(lines), 1))
+        self.assertEqual(out, lines[:16])
+        self.assertTrue(lines[16].startswith(b'-' * 72))
+
+    def test_limit_commits_stops_reading(self):
+        lines = self._read_lines('git-log')
+        stream = iter(lines * 1000)
+        out = list(ydiff._limit_commits(stream, 3))
+        self.assertEqual(len(out), 37 + 19)
+        self.assertEqual(len(list(stream)), 37 * 1000 - 37 - 20)
+
+    def test_commit_cache(self):
+        lines = self._read_lines('git-log')
+        marker = ydiff.DiffMarker(side_by_side=True, width=40)
+        calls = []
+
+        def markup(diff):
+            calls.append(diff)
+            return ydiff.DiffMarker.markup(marker, diff)
+
+        marker.markup = markup
+        want = ''.join(ydiff._markup_diffs(
+            ydiff.DiffParser(iter(lines)).parse(), marker, '---\n'))
+        self.assertEqual(len(calls), 2)
+
+        cache_dir = tempfile.mkdtemp(prefix='test_ydiff')
+        try:
+            for i in range(2):
+                cache = ydiff._CommitCache(cache_dir, ('params',))
+                diffs = ydiff.DiffParser(iter(lines)).parse()
+                got = ''.join(cache.markup(diffs, marker, '---\n'))
+                self.assertEqual(want, got)
+            self.assertEqual(len(calls), 4)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # Different parameters do not share the cache
+            cache = ydiff._CommitCache(cache_dir, ('other params',))
+            diffs = ydiff.DiffParser(iter(lines)).parse()
+            got = ''.join(cache.markup(diffs, marker, '---\n'))
+            self.assertEqual(want, got)
+            self.assertEqual(len(calls), 6)
+        finally:
+            subprocess.call(['/bin/rm', '-rf', cache_dir])
+
+    def test_cache_params(self):
+        argv = sys.argv
+        try:
+            sys.argv = [sys.argv[0], '-l', '--cache-dir', 'D']
+            opts, args = ydiff._parse_args()
+            params = ydiff._commit_cache_params(opts, args)
+            self.assertNotEqual(params,
+                                ydiff._commit_cache_params(opts, ['y']))
+            sys.argv.extend(['--encoding', 'latin-1'])
+            opts, args = ydiff._parse_args()
+            self.assertNotEqual(params,
+                                ydiff._commit_cache_params(opts, args))
+        finally:
+            sys.argv = argv
+
+
+class RecordsTest(unittest.TestCase):
+
+    _patch = [
+        b'Only in dir: baz\n',
+        b'Binary files a/x.bin and b/x.bin differ\n',
+        b'diff --git a/f b/f\n',
+        b'--- a/f\n',
+        b'+++ b/f\n',
+        b'@@ -10,4 +20,3 @@ def f():\n',
+        b' same\n',
+        b'-old line\n',
+        b'-gone\n',
+        b'+new line\n',
+        b' end\n',
+        b'@@ -30 +29,2 @@\n',
+        b' x\n',
+        b'+y\n',
+    ]
+
+    def _records(self):
+        return list(ydiff._records(ydiff.DiffParser(iter(self._patch))
+                                   .parse()))
+
+    def test_header_only(self):
+        records = self._records()
+        self.assertEqual(records[:2], [
+            {'type': 'file', 'headers': ['Only in dir: baz\n'],
+             'old_path': '', 'new_path': ''},
+            {'type': 'file',
+             'headers': ['Binary files a/x.bin and b/x.bin differ\n'],
+             'old_path': '', 'new_path': ''}])
+
+    def test_records(self):
+        records = self._records()[2:]
+        self.assertEqual(records[:2], [
+            {'type': 'file', 'headers': ['diff --git a/f b/f\n'],
+             'old_path': 'a/f', 'new_path': 'b/f'},
+            {'type': 'hunk', 'headers': [],
+             'meta': '@@ -10,4 +20,3 @@ def f():\n',
+             'old_addr': [10, 4], 'new_addr': [20, 3]}])
+        rows = [(r['changed'], r['old_num'], r['new_num'], r['old'], r['new'])
+                for r in records[2:6]]
+        self.assertEqual(rows, [
+            (False, 10, 20, [['=', 'same\n']], [['=', 'same\n']]),
+            (True, 11, 21, [['^', 'old'], ['=', ' line\n']],
+             [['^', 'new'], ['=', ' line\n']]),
+            (True, 12, None, [['-', 'gone\n']], []),
+            (False, 13, 22, [['=', 'end\n']], [['=', 'end\n']])])
+        self.assertEqual(records[6]['type'], 'hunk')
+        self.assertEqual(records[8], {
+            'type': 'row', 'changed': True, 'old_num': None, 'new_num': 30,
+            'old': [], 'new': [['+', 'y\n']]})
+        self.assertEqual(len(records), 9)
+
+    def test_spans(self):
+        self.assertEqual(ydiff._spans('a\0-b\1c\0^d\1\0+e'), [
+            ['=', 'a'], ['-', 'b'], ['=', 'c'], ['^', 'd'], ['+', 'e']])
+        self.assertEqual(ydiff._spans(''), [])
+
+    def test_write_records(self):
+        argv = sys.argv
+        output = io.TextIOWrapper(io.BytesIO())
+        try:
+            sys.argv = [sys.argv[0], '--format', 'jsonl']
+            opts, _ = ydiff._parse_args()
+            with unittest.mock.patch('sys.stdout', output):
+                ydiff.write_records(
+                    ydiff.DiffParser(iter(self._patch)).parse(), opts)
+        finally:
+            sys.argv = argv
+        lines = output.buffer.getvalue().split(b'\n')
+        self.assertEqual(lines[-1], b'')
+        self.assertEqual([json.loads(line) for line in lines[:-1]],
+                         self._records())
+
+
+class DiffstatTest(unittest.TestCase):
+
+    def test_same_as_parser(self):
+        for path in glob.glob(os.path.join('tests', '*', 'in.diff')):
+            with open(path, 'rb') as f:
+                lines = f.readlines()
+            want = []
+            for diff in ydiff.DiffParser(iter(lines)).parse():
+                attrs = [a for h in diff._hunks for a, _ in h._hunk_list]
+                if diff._old_path:
+                    want.append((attrs.count('+'), attrs.count('-')))
+            got = [(a, d) for _, a, d in ydiff._diffstat(iter(lines))
+                   if a is not None]
+            self.assertEqual(want, got, path)
+
+    def test_diffstat(self):
+        patch = b"""\
+diff --git a/foo b/foo
+--- a/foo
++++ b/foo
+@@ -1,3 +1,2 @@
+--- not a path
++++ not a path
+-bar
+ baz
+diff --git a/new b/new
+new file mode 100644
+--- /dev/null
++++ b/new
+@@ -0,0 +1 @@
++new
+Binary files a/foo.pdf and b/foo.pdf differ
+Only in dir: file
+"""
+        stats = list(ydiff._diffstat(iter(patch.splitlines(True))))
+        self.assertEqual(stats, [('foo', 1, 2), ('new', 1, 0),
+                                 ('foo.pdf', None, 'Bin'),
+                                 ('dir/file', None, 'Only')])
+        self.assertEqual(ydiff._format_diffstat(stats), [
+            ' foo      |    3 +--\n',
+            ' new      |    1 +\n',
+            ' foo.pdf  |  Bin\n',
+            ' dir/file | Only\n',
+            ' 4 files changed, 2 insertions(+), 2 deletions(-)\n',
+        ])
+
+    def test_format_scaled(self):
+        stats = [('foo', 300, 100), ('bar', 1, 0)]
+        lines = ydiff._format_diffstat(stats, width=30)
+        self.assertEqual(lines[0], ' foo | 400 ' + '+' * 13 + '-' * 5 + '\n')
+        self.assertEqual(lines[1], ' bar |   1 +\n')
+        self.assertEqual(ydiff._format_diffstat([('foo', 0, 1)])[-1],
+                         ' 1 file changed, 1 deletion(-)\n')
+
+
+class GrepTest(unittest.TestCase):
+
+    def _diffs(self):
+        patch = b"""\
+--- a/foo
++++ b/foo
+@@ -1,2 +1,2 @@
+ hello
+-foo
++bar
+@@ -10,2 +10,2 @@
+ foo
+-hello
++world
+--- a/bar
++++ b/bar
+@@ -1 +1 @@
+-hello
++world
+Only in dir: baz
+"""
+        return ydiff.DiffParser(iter(patch.splitlines(True))).parse()
+
+    def test_grep(self):
+        out = list(ydiff._grep_diffs(self._diffs(), re.compile('^hel')))
+        self.assertEqual([d._new_path for d in out], ['+++ b/foo\n',
+                                                      '+++ b/bar\n'])
+        # Common lines do not match
+        self.assertEqual([h._hunk_meta for h in out[0]._hunks],
+                         ['@@ -10,2 +10,2 @@\n'])
+
+    def test_grep_files(self):
+        out = list(ydiff._grep_diffs(self._diffs(),
+                                     path_pattern=re.compile('ba')))
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0]._old_path, '--- a/bar\n')
+        self.assertEqual(out[1]._headers, ['Only in dir: baz\n'])
+
+        out = list(ydiff._grep_diffs(self._diffs(), re.compile('world'),
+                                     re.compile('foo')))
+        self.assertEqual(len(out), 1)
+        self.assertEqual(len(out[0]._hunks), 1)
+
+    def test_no_newline_at_eof(self):
+        # Output of --grep without colors is a patch to apply as well
+        patch = (b'--- o/f\t2026-01-01 00:00:00 +0000\n'
+                 b'+++ n/f\t2026-01-01 00:00:00 +0000\n'
+                 b'@@ -1,2 +1,2 @@\n'
+                 b' a\n'
+                 b'-b\n'
+                 b'\\ No newline at end of file\n'
+                 b'+c\n'
+                 b'\\ No newline at end of file\n')
+        diffs = ydiff.DiffParser(iter(patch.splitlines(True))).parse()
+        out = list(ydiff._grep_diffs(diffs, re.compile('c')))
+        text = ''.join(ydiff._diff_lines(out[0])).encode('utf-8')
+        self.assertEqual(text, patch)
+
+
+class CompactAnsiTest(unittest.TestCase):
+
+    def _screen(self, text):
+        """Returns rows of (char, effects) cells text shows on a terminal,
+        for a blank only background, reverse, underline, strikethrough and
+        their color count.
+        """
+        rows = [[]]
+        state = {}
+        for part in re.split(r'(\x1b\[[0-9;]*m)', text):
+            if part.startswith('\x1b['):
+                state = ydiff._sgr_apply(state, part[2:-1])
+                continue
+            for char in part:
+                effects = state
+                if char.isspace():
+                    effects = {k: v for k, v in state.items()
+                               if k in ('bg', 4, 7, 9)}
+                    if effects.keys() - {'bg'}:
+                        effects['fg'] = state.get('fg')
+                rows[-1].append((char, sorted(effects.values())))
+                if char == '\n':
+                    rows.append([])
+        return rows
+
+    def test_sgr_apply(self):
+        state = ydiff._sgr_apply({}, '7;31')
+        self.assertEqual({7: '7', 'fg': '31'}, state)
+        state = ydiff._sgr_apply(state, '38;5;235;48;2;1;2;3')
+        self.assertEqual({7: '7', 'fg': '38;5;235', 'bg': '48;2;1;2;3'},
+                         state)
+        self.assertEqual({'bg': '48;2;1;2;3'},
+                         ydiff._sgr_apply(state, '27;39'))
+        self.assertEqual({}, ydiff._sgr_apply(state, ''))
+        self.assertIsNone(ydiff._sgr_apply(state, '38;9'))
+        self.assertIsNone(ydiff._sgr_apply(None, '32'))
+        self.assertEqual({'fg': '32'}, ydiff._sgr_apply(None, '0;32'))
+
+    def test_compact(self):
+        lines = ['\x1b[33m1\x1b[0m \x1b[31mfoo\x1b[0m\x1b[0m \x1b[7m\x1b[31m',
+                 'bar\n\x1b[0m', '\x1b[33m2\x1b[0m baz\n\x1b[0m']
+        self.assertEqual(['\x1b[33m1 \x1b[31mfoo ', '\x1b[7mbar\n',
+                          '\x1b[0;33m2\x1b[0m baz\n', '\x1b[0m'],
+                         list(ydiff._compact_ansi(lines)))
+
+    def test_unknown_escape(self):
+        lines = ['\x1b[31ma\x1b[5;99mb\x1b[32mc\x1b[0;34md\x1b[0m\n']
+        self.assertEqual(
+            ['\x1b[31ma\x1b[5;99mb\x1b[32mc\x1b[0;34md\n', '\x1b[0m'],
+            list(ydiff._compact_ansi(lines)))
+
+    def test_same_as_fixtures(self):
+        for path in glob.glob(os.path.join('tests', '*', 'out.*')):
+            with open(path, 'rb') as f:
+                text = f.read().decode('utf-8', 'surrogateescape')
+            lines = re.findall(r'[^\n]*\n|[^\n]+$', text)
+            compact = ''.join(ydiff._compact_ansi(lines))
+            if '\x1b' in text:
+                self.assertLess(len(compact), len(text), path)
+            self.assertEqual(self._screen(text), self._screen(compact), path)
+            # Each line on its own as well, e.g. in a pager
+            for want, got in zip(text.split('\n'), compact.split('\n')):
+                if want.startswith('\x1b'):
+                    self.assertEqual(self._screen(want), self._screen(got),
+                                     path)
+
+
+class ScalingTest(unittest.TestCase):
+    """Work on an input 8 times as large must take less than 20 times as
+    long, a quadratic path takes about 64 times.  Ratio of the best CPU time
+    of a few runs is compared instead of absolute time, which depends on the
+    host and its load.
+    """
+
+    K = 8
+
+    def _best(self, fn, arg):
+        # Garbage collection is off as in timeit, a large input triggers more
+        times = []
+        gc.disable()
+        try:
+            for _ in range(5):
+                start = time.process_time()
+                fn(arg)
+                times.append(time.process_time() - start)
+        finally:
+            gc.enable()
+        return min(times)
+
+    def _assert_linear(self, fn, make_input, n):
+        ratio = (self._best(fn, make_input(n * self.K)) /
+                 self._best(fn, make_input(n)))
+        self.assertLess(ratio, 2.5 * self.K)
+
+    def test_hunk_length(self):
+        # Old lines like '--- ' make the parser check if the hunk completes
+        def patch(size):
+            return ([b'--- a/foo\n', b'+++ b/foo\n',
+                     ('@@ -1,%d +1,%d @@\n' % (size, size)).encode('ascii')] +
+                    [('--- %d\n' % i).encode('ascii') for i in range(size)] +
+                    [('+++ %d\n' % i).encode('ascii') for i in range(size)])
+
+        self._assert_linear(lambda lines: list(ydiff.DiffParser(
+            iter(lines)).parse()), patch, 1000)
+
+    def test_file_count(self):
+        def patch(size):
+            lines = []
+            for i in range(size):
+                lines.extend([('--- a/f%d\n' % i).encode('ascii'),
+                              ('+++ b/f%d\n' % i).encode('ascii'),
+                              b'@@ -1 +1 @@\n', b'-foo\n', b'+bar\n'])
+            return lines
+
+        def markup(lines):
+            marker = ydiff.DiffMarker(side_by_side=True, width=40)
+            diffs = ydiff.DiffParser(iter(lines)).parse()
+            for _ in ydiff._markup_diffs(diffs, marker, ''):
+                pass
+
+        self._assert_linear(markup, patch, 100)
+
+    def test_tab_count(self):
+        marker = ydiff.DiffMarker()
+        self._assert_linear(marker._normalize, lambda n: 'a\t' * n, 1000)
+
+    def test_line_length(self):
+        marker = ydiff.DiffMarker(side_by_side=True, wrap=True)
+        self._assert_linear(lambda text: marker._split_parts(text, text, 1),
+                            lambda n: 'x' * n, 20000)
+        marker = ydiff.DiffMarker(side_by_side=True, wrap=False)
+        self._assert_linear(lambda text: marker._split_parts(text, text, 40),
+                            lambda n: 'x' * n, 20000)
+
+    def test_wide_char_count(self):
+        marker = ydiff.DiffMarker(side_by_side=True, wrap=True)
+        self._assert_linear(lambda text: marker._split_parts(text, '', 2),
+                            lambda n: '字' * n, 10000)
+
+
+@unittest.skipIf(os.name == 'nt', 'Travis CI Windows not ready for shell cmds')
+class PagerQuitTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='test_ydiff')
+        self._quit_flag = os.path.join(self._dir, 'quit')
+        self._pager = os.path.join(self._dir, 'pager')
+        with open(self._pager, 'w') as f:
+            f.write('#!/bin/sh\nhead -c 8192 > /dev/null\ntouch %s\n' %
+                    self._quit_flag)
+        os.chmod(self._pager, 0o755)
+        self._argv = sys.argv
+        # Embedded use, where SIGPIPE does not kill us
+        self._sigpipe = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+    def tearDown(self):
+        signal.signal(signal.SIGPIPE, self._sigpipe)
+        sys.argv = self._argv
+        subprocess.call(['/bin/rm', '-rf', self._dir])
+
+    def test_stop_after_pager_quit(self):
+        total = 20000
+        pulled = {'before': 0, 'after': 0}
+
+        def stream():
+            for i in range(total):
+                when = 'after' if os.path.exists(self._quit_flag) else 'before'
+                pulled[when] += 1
+                for line in [b'--- a\n', b'+++ b\n', b'@@ -1 +1 @@\n',
+                             b'-foo\n', b'+bar\n']:
+                    yield line
+
+        sys.argv = [sys.argv[0], '-u', '--pager', self._pager]
+        opts, _ = ydiff._parse_args()
+        ydiff.markup_to_pager(ydiff.DiffParser(stream()).parse(), opts)
+
+        self.assertTrue(os.path.exists(self._quit_flag))
+        self.assertLess(pulled['before'], total / 10)
+        # Only what was rendered between pager's exit and our next liveness
+        # check is wasted work
+        self.assertLess(pulled['after'], total / 100)
+
+    def test_stop_producer(self):
+        stream = ydiff._ProcessStream(['yes', '+spam'])
+        lines = iter(stream)
+        self.assertEqual(next(lines), b'+spam\n')
+        stream.close()
+        self.assertIsNotNone(stream._proc.poll())
+
+
+@unittest.skipIf(os.name == 'nt', 'Travis CI Windows not ready for shell cmds')
+class DecompressTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join('tests', 'crlf', 'in.diff'), 'rb') as f:
+            self._data = f.read()
+        self._lines = self._data.split(b'\n')
+
+    def _stream(self, data):
+        return ydiff._maybe_decompressed(io.BufferedReader(io.BytesIO(data)))
+
+    def _check_lines(self, stream):
+        got = list(stream)
+        stream.close()
+        self.assertEqual(self._data, b''.join(got))
+        self.assertEqual(self._lines[:-1], [x[:-1] for x in got])
+
+    def test_formats(self):
+        for compress in (gzip.compress, bz2.compress, lzma.compress):
+            stream = self._stream(compress(self._data))
+            self.assertIsInstance(stream, ydiff._DecompressedStream)
+            self._check_lines(stream)
+
+    def test_small_blocks(self):
+        for size in (1, 7, 100):
+            with unittest.mock.patch('ydiff._DECOMPRESS_BLOCK_SIZE', size):
+                self._check_lines(self._stream(gzip.compress(self._data)))
+
+    def test_not_compressed(self):
+        stream = self._stream(self._data)
+        self.assertNotIsInstance(stream, ydiff._DecompressedStream)
+        self._check_lines(stream)
+
+    def test_truncated(self):
+        with unittest.mock.patch('ydiff._DECOMPRESS_BLOCK_SIZE', 64), \
+                unittest.mock.patch('sys.stderr') as stderr:
+            stream = self._stream(gzip.compress(self._data)[:-10])
+            lines = list(stream)
+        stream.close()
+        self.assertTrue(b''.join(lines) and
+                        self._data.startswith(b''.join(lines)))
+        self.assertIn('*** Bad compressed input',
+                      stderr.write.call_args[0][0])
+
+    def test_corrupt(self):
+        data = bytearray(gzip.compress(self._data * 50))
+        middle = len(data) // 2
+        data[middle:middle + 40] = bytes(b ^ 0xff for b in
+                                         data[middle:middle + 40])
+        lines = []
+        with unittest.mock.patch('sys.stderr') as stderr:
+            stream = self._stream(bytes(data))
+            reader = threading.Thread(target=lambda: lines.extend(stream),
+                                      daemon=True)
+            reader.start()
+            reader.join(10)
+        self.assertFalse(reader.is_alive())     # the worker always ends it
+        stream.close()
+        self.assertTrue((self._data * 50).startswith(b''.join(lines)))
+        self.assertIn('*** Bad compressed input',
+                      stderr.write.call_args[0][0])
+        self.assertFalse(stream._thread.is_alive())
+
+    def test_close_early(self):
+        data = lzma.compress(self._data * 1000)
+        with unittest.mock.patch('ydiff._DECOMPRESS_BLOCK_SIZE', 64):
+            stream = self._stream(data)
+            next(iter(stream))
+            stream.close()
+        self.assertFalse(stream._thread.is_alive())
+
+    def test_open_compressed(self):
+        fd, path = tempfile.mkstemp(prefix='test_ydiff')
+        os.write(fd, gzip.compress(self._data))
+        os.close(fd)
+        try:
+            self._check_lines(ydiff._open_compressed(path))
+            with open(path, 'wb') as f:
+                f.write(self._data)
+            self.assertIsNone(ydiff._open_compressed(path))
+        finally:
+            os.remove(path)
+
+    def test_file_argument(self):
+        directory = tempfile.mkdtemp(prefix='test_ydiff')
+        try:
+            for name in ('data.gz', 'x.diff.gz', 'x.patch.xz'):
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(gzip.compress(self._data))
+            for vcs, name, patch in [(None, 'data.gz', True),
+                                     ('Git', 'data.gz', False),
+                                     ('Git', 'x.diff.gz', True),
+                                     ('Git', 'x.patch.xz', True)]:
+                path = os.path.join(directory, name)
+                with unittest.mock.patch('sys.stdin') as stdin, \
+                        unittest.mock.patch('ydiff._revision_control_probe',
+                                            return_value=vcs), \
+                        unittest.mock.patch('ydiff._ProcessStream') as proc:
+                    stdin.isatty.return_value = True
+                    stream = ydiff._get_patch_stream([path], False)
+                if patch:
+                    self._check_lines(stream)
+                else:
+                    self.assertIs(stream, proc.return_value)
+                    proc.assert_called_once_with(
+                        ydiff._VCS_INFO['Git']['diff'] + [path])
+        finally:
+            subprocess.call(['/bin/rm', '-rf', directory])
+
+
+class GitParallelStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._ws = tempfile.mkdtemp(prefix='test_ydiff')
+        cmd = ('set -o errexit; cd %s; git init; git config user.name me; '
+               'git config user.email me@example.org; '
+               'for x in a b c "d e" f; do seq 1 20 > "$x"; done; '
+               'git add .; git commit -m init; '
+               'echo changed >> a; rm b; sed -i.bak 5d "d e"; rm "d e.bak"; '
+               'git mv f g; echo new > h; git add h; '
+               'printf "x\\ry\\r\\n" >> c') % self._ws
+        subprocess.call(cmd, shell=True, stdout=subprocess.PIPE)
+        os.chdir(self._ws)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        subprocess.call(['/bin/rm', '-rf', self._ws])
+
+    def _check_same_as_git_diff(self, args):
+        cmd = ['git', 'diff', '--no-ext-diff', '--color=never'] + args
+        want = subprocess.check_output(cmd)
+        stream = ydiff._GitParallelStream(args, 3)
+        got = list(stream)
+        stream.close()
+        self.assertTrue(want)
+        self.assertEqual(want, b''.join(got))
+        self.assertEqual(want.split(b'\n')[:-1],
+                         [x[:-1] for x in got])     # split on LF only
+
+    def test_workspace(self):
+        self._check_same_as_git_diff([])
+
+    def test_cached(self):
+        self._check_same_as_git_diff(['--cached'])
+
+    def test_pathspec(self):
+        self._check_same_as_git_diff(['HEAD', '--', 'a', 'd e'])
+        self._check_same_as_git_diff(['a'])
+
+    def test_subdirectory(self):
+        cmd = ('set -o errexit; mkdir sub; seq 1 20 > sub/i; git add sub; '
+               'git commit -m sub; echo changed >> sub/i')
+        subprocess.call(cmd, shell=True, stdout=subprocess.PIPE)
+        os.chdir('sub')
+        self._check_same_as_git_diff([])
+        self._check_same_as_git_diff(['--', '.'])
+
+
+class GitWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._ws = tempfile.mkdtemp(prefix='test_ydiff')
+        cmd = ('set -o errexit; cd %s; git init; git config user.name me; '
+               'git config user.email me@example.org; mkdir sub; '
+               'for x in a b sub/c; do seq 1 20 > "$x"; done; '
+               'git add .; git commit -m init; echo changed >> a') % self._ws
+        subprocess.call(cmd, shell=True, stdout=subprocess.PIPE)
+        os.chdir(self._ws)
+        self._rendered = []
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        subprocess.call(['/bin/rm', '-rf', self._ws])
+
+    def _render(self, diffs):
+        paths = [diff._new_path for diff in diffs]
+        self._rendered.extend(paths)
+        return ''.join(paths)
+
+    def _append(self, path, text):
+        with open(path, 'a') as f:
+            f.write(text)
+
+    def test_poll(self):
+        watcher = ydiff._GitWatcher([], self._render)
+        self.assertTrue(watcher.poll())
+        self.assertEqual(['+++ b/a\n'], self._rendered)
+        self.assertFalse(watcher.poll())
+        self.assertEqual(['+++ b/a\n'], self._rendered)
+
+        self._append('b', 'changed\n')
+        self.assertTrue(watcher.poll())
+        self.assertEqual(['+++ b/a\n', '+++ b/b\n'], self._rendered)
+        self.assertEqual('+++ b/a\n|+++ b/b\n', watcher.text('|'))
+
+        self._append('a', 'again\n')
+        self.assertTrue(watcher.poll())
+        self.assertEqual(['+++ b/a\n', '+++ b/b\n', '+++ b/a\n'],
+                         self._rendered)
+
+        subprocess.call(['git', 'checkout', 'a'], stderr=subprocess.PIPE)
+        self.assertTrue(watcher.poll())
+        self.assertEqual('+++ b/b\n', watcher.text('|'))
+        self.assertEqual(3, len(self._rendered))
+
+        watcher.refresh()
+        self.assertEqual('+++ b/b\n', self._rendered[-1])
+        self.assertEqual(4, len(self._rendered))
+
+    def test_cached(self):
+        subprocess.call(['git', 'add', 'a'])
+        watcher = ydiff._GitWatcher(['--cached'], self._render)
+        self.assertTrue(watcher.poll())
+        self.assertEqual(['+++ b/a\n'], self._rendered)
+
+        # Staged again without touching the work tree, e.g. `git add -p`
+        blob = subprocess.Popen(
+            ['git', 'hash-object', '-w', '--stdin'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE).communicate(b'other\n')[0]
+        subprocess.call(['git', 'update-index', '--cacheinfo', '100644',
+                         blob.strip().decode(), 'a'])
+        self.assertTrue(watcher.poll())
+        self.assertEqual(['+++ b/a\n', '+++ b/a\n'], self._rendered)
+        self.assertFalse(watcher.poll())
+
+    def test_subdirectory(self):
+        os.chdir('sub')
+        self._append('c', 'changed\n')
+        watcher = ydiff._GitWatcher(['--', '.'], self._render, 2)
+        self.assertTrue(watcher.poll())
+        self.assertEqual('+++ b/sub/c\n', watcher.text('|'))
+        watcher = ydiff._GitWatcher([], self._render, 2)
+        self.assertTrue(watcher.poll())
+        self.assertEqual('+++ b/a\n|+++ b/sub/c\n', watcher.text('|'))
+
+
+class ComparePathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='test_ydiff')
+
+    def tearDown(self):
+        subprocess.call(['/bin/rm', '-rf', self._dir])
+
+    def _write(self, path, data, mtime=1000000000):
+        path = os.path.join(self._dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_same_as_difflib(self):
+        rand = random.Random(42)
+        words = ['foo\n', 'bar\n', 'baz\n', '\n', '}\n']
+        for _ in range(100):
+            a = [rand.choice(words) for _ in range(rand.randint(0, 30))]
+            b = a[:]
+            for _ in range(rand.randint(1, 4)):
+                i = rand.randint(0, len(b))
+                b[i:i + rand.randint(0, 3)] = [
+                    rand.choice(words) for _ in range(rand.randint(0, 3))]
+            want = list(difflib.unified_diff(a, b))[2:]
+            diff = ydiff.UnifiedDiff([], '', '', ydiff._unified_hunks(a, b))
+            self.assertEqual(list(ydiff._diff_lines(diff)), want)
+
+    def test_compare_files(self):
+        old = self._write('old', b'one\ntwo\n\xe9\n')
+        new = self._write('new', b'one\n2\n\xe9')
+        diffs = list(ydiff.compare_paths(old, new))
+        self.assertEqual(len(diffs), 1)
+        self.assertTrue(diffs[0]._old_path.startswith('--- %s\t' % old))
+        self.assertEqual(diffs[0]._hunks[0]._hunk_list, [
+            (' ', 'one\n'), ('-', 'two\n'), ('-', 'é\n'), ('+', '2\n'),
+            ('+', 'é\n')])
+
+        # Parsed back from text the same
+        text = ''.join(ydiff._diff_lines(diffs[0])).encode('utf-8')
+        parsed = list(ydiff.DiffParser(text.splitlines(True)).parse())
+        self.assertEqual(parsed[0]._hunks[0]._hunk_list,
+                         diffs[0]._hunks[0]._hunk_list)
+        self.assertEqual(list(ydiff.compare_paths(old, old)), [])
+
+    def test_no_newline_at_eof(self):
+        old = self._write('old', b'a\nb')
+        new = self._write('new', b'a\nc')
+        diff = list(ydiff.compare_paths(old, new))[0]
+        self.assertEqual(list(ydiff._diff_lines(diff))[2:], [
+            '@@ -1,2 +1,2 @@\n', ' a\n', '-b\n',
+            '\\ No newline at end of file\n', '+c\n',
+            '\\ No newline at end of file\n'])
+        diff = ydiff.UnifiedDiff([], '', '', ydiff._unified_hunks(
+            ['a\n', 'b'], ['c\n', 'b']))
+        self.assertEqual(list(ydiff._diff_lines(diff)), [
+            '@@ -1,2 +1,2 @@\n', '-a\n', '+c\n', ' b\n',
+            '\\ No newline at end of file\n'])
+
+    def test_compare_dirs(self):
+        a = os.path.join(self._dir, 'a')
+        b = os.path.join(self._dir, 'b')
+        self._write('a/changed', b'foo\n')
+        self._write('b/changed', b'bar\n', 2000000000)    # same size
+        self._write('a/touched', b'foo\n')
+        self._write('b/touched', b'foo\n', 2000000000)
+        self._write('a/bin', b'\0foo')
+        self._write('b/bin', b'\0bar\n')
+        self._write('a/gone/x', b'x\n')
+        self._write('a/kind/x', b'x\n')
+        self._write('b/kind', b'x\n')
+        self._write('a/sub/grown', b'x\n')
+        self._write('b/sub/grown', b'x\ny\n')
+        self._write('b/sub/new', b'y\n')
+        # Taken as unchanged without reading, as size and mtime are the same
+        self._write('a/sub/quick', b'foo\n')
+        self._write('b/sub/quick', b'bar\n')
+
+        diffs = list(ydiff.compare_paths(a, b, jobs=2))
+        self.assertEqual([d._headers or [d._new_path[4:].split('\t')[0]]
+                          for d in diffs], [
+            ['Binary files %s/bin and %s/bin differ\n' % (a, b)],
+            ['%s/changed' % b],
+            ['Only in %s: gone\n' % a],
+            ['File %s/kind is a directory while file %s/kind is a regular '
+             'file\n' % (a, b)],
+            ['%s/sub/grown' % b],
+            ['Only in %s/sub: new\n' % b],
+        ])
+        self.assertEqual(diffs[4]._hunks[0]._hunk_list,
+                         [(' ', 'x\n'), ('+', 'y\n')])
+
+    def test_unreadable(self):
+        a = os.path.join(self._dir, 'a')
+        b = os.path.join(self._dir, 'b')
+        self._write('a/locked/x', b'x\n')
+        self._write('b/locked/x', b'y\n')
+        self._write('a/secret', b'foo\n')
+        self._write('b/secret', b'bar\n', 2000000000)    # to be hashed
+        self._write('a/z', b'z\n')
+        self._write('b/z', b'zz\n')
+        locked = os.path.join(a, 'locked')
+        secret = os.path.join(b, 'secret')
+        listdir, real_open = os.listdir, open
+
+        def denied(path):
+            raise PermissionError(errno.EACCES, 'Permission denied', path)
+
+        def fake_listdir(path):
+            return denied(path) if path == locked else listdir(path)
+
+        def fake_open(path, *args):
+            return denied(path) if path == secret else real_open(path, *args)
+
+        with unittest.mock.patch('os.listdir', fake_listdir), \
+                unittest.mock.patch('ydiff.open', fake_open, create=True):
+            diffs = list(ydiff.compare_paths(a, b))
+            self.assertEqual(
+                [d._headers or [d._new_path[4:].split('\t')[0]]
+                 for d in diffs], [
+                    ['diff: %s: Permission denied\n' % locked],
+                    ['diff: %s: Permission denied\n' % secret],
+                    ['%s/z' % b]])
+            diffs = list(ydiff.compare_paths(os.path.join(a, 'secret'),
+                                             secret))
+            self.assertEqual(diffs[0]._headers,
+                             ['diff: %s: Permission denied\n' % secret])
+
+    @unittest.skipIf(os.name == 'nt', 'symlinks need privileges on Windows')
+    def test_symlinks(self):
+        a = os.path.join(self._dir, 'a')
+        b = os.path.join(self._dir, 'b')
+        self._write('a/f', b'x\n')
+        self._write('b/f', b'x\n')
+        self._write('b/kind', b'x\n')
+        for link, target in [('a/up', '..'), ('b/up', '..'),
+                             ('a/target', 'x'), ('b/target', 'y'),
+                             ('a/kind', 'f')]:
+            os.symlink(target, os.path.join(self._dir, link))
+        diffs = list(ydiff.compare_paths(a, b))
+        self.assertEqual([d._headers for d in diffs], [
+            ['File %s/kind is a symbolic link while file %s/kind is a '
+             'regular file\n' % (a, b)],
+            ['Symbolic links %s/target and %s/target differ\n' % (a, b)]])
+
+
 @unittest.skipIf(os.name == 'nt', 'Travis CI Windows not ready for shell cmds')
 class MainTest(unittest.TestCase):
 
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bisect
+import bz2
+import codecs
+import collections
 import difflib
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import html
+import io
+import itertools
+import json
+import lzma
 import os
+import queue
 import re
 import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import types
 import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 __version__ = '1.4.2'
 __homepage__ = 'https://github.com/ymattw/ydiff'
@@ -101,6 +122,11 @@ _THEMES = {
         'wrap_marker': [_Color.FG_BRIGHT_MAGENTA],
     },
 }
+# Read by rendering threads at the same time, see DiffMarker._render_hunks()
+_THEMES = types.MappingProxyType({
+    name: types.MappingProxyType({
+        kind: tuple(effects) for kind, effects in theme.items()})
+    for name, theme in _THEMES.items()})
 
 
 def _colorize(text, kind, theme='default'):
@@ -125,6 +151,115 @@ def _colorize(text, kind, theme='default'):
     return base_color + text + _Color.RESET
 
 
+# Select Graphic Rendition escape, i.e. a change of colors or effects
+_SGR_ESCAPE = re.compile(r'\x1b\[([0-9;]*)m')
+
+
+def _sgr_apply(state, params: str):
+    """Returns SGR state (a dict of slot: parameter text) after an escape of
+    given parameters, None for an unknown state, e.g. after a parameter not
+    understood, until a reset.
+    """
+    codes = params.split(';') if params else ['0']
+    state = None if state is None else dict(state)
+    i = 0
+    while i < len(codes):
+        if not codes[i].isdigit():
+            return None
+        n = int(codes[i])
+        size = 1
+        if n in (38, 48):   # 8-bit or 24-bit color
+            size = {'5': 3, '2': 5}.get(codes[i + 1] if i + 1 < len(codes)
+                                        else None, 0)
+            if not size or not all(x.isdigit() for x in codes[i:i + size]):
+                return None
+        if n == 0:
+            state = {}
+        elif state is None:
+            pass
+        elif 1 <= n <= 9:
+            state[n] = str(n)
+        elif n == 22:
+            state.pop(1, None)
+            state.pop(2, None)
+        elif 23 <= n <= 29:
+            state.pop(n - 20, None)
+        elif 30 <= n <= 37 or 90 <= n <= 97 or n == 38:
+            state['fg'] = ';'.join(codes[i:i + size])
+        elif 40 <= n <= 47 or 100 <= n <= 107 or n == 48:
+            state['bg'] = ';'.join(codes[i:i + size])
+        elif n in (39, 49):
+            state.pop('fg' if n == 39 else 'bg', None)
+        else:
+            return None
+        i += size
+    return state
+
+
+def _sgr_transition(old, new) -> str:
+    """Returns the shortest escape from SGR state old to new"""
+    if old is None or any(slot not in new for slot in old):
+        codes = ['0'] + list(new.values())
+    else:
+        codes = [code for slot, code in new.items() if old.get(slot) != code]
+    return '\x1b[%sm' % ';'.join(codes) if codes else ''
+
+
+def _looks_same(text, old, new) -> bool:
+    """Tell if text looks the same in SGR states old and new, only when it is
+    blank and none of background, reverse, underline or strikethrough, i.e.
+    what makes a blank visible, differs.
+    """
+    if old is None or not text.isspace():
+        return False
+    slots = ['bg', 4, 7, 9]
+    if any(slot in new for slot in slots[1:]):
+        slots.append('fg')  # color of reverse video or lines
+    return all(old.get(slot) == new.get(slot) for slot in slots)
+
+
+def _compact_ansi(lines):
+    """Yields lines with SGR escapes coalesced: states are tracked and only
+    the change in front of visible text is written, as one escape.  Where a
+    line starts with escapes, the state is written in full as if after a
+    reset, so each line still looks the same on its own, e.g. in a pager.
+    """
+    emitted = desired = {}
+    line_start = False
+    for line in lines:
+        if '\x1b' not in line and emitted == desired:
+            yield line
+            line_start = line.endswith('\n') if line else line_start
+            continue
+        out = []
+        pos = 0
+        for match in itertools.chain(_SGR_ESCAPE.finditer(line), [None]):
+            text = line[pos:match.start()] if match else line[pos:]
+            if text:
+                if (desired is not None and emitted != desired and
+                        not _looks_same(text, emitted, desired)):
+                    out.append(_sgr_transition(emitted, desired))
+                    emitted = desired
+                out.append(text)
+                line_start = text.endswith('\n')
+            if match is None:
+                break
+            pos = match.end()
+            if line_start:
+                emitted = None
+            state = _sgr_apply(desired, match.group(1))
+            if state is None:
+                # Not understood, pass through and start over after a reset
+                if desired is not None and emitted != desired:
+                    out.append(_sgr_transition(emitted, desired))
+                out.append(match.group(0))
+                emitted = None
+            desired = state
+        yield ''.join(out)
+    if desired is not None and emitted != desired:
+        yield _sgr_transition(emitted, desired)
+
+
 def _strsplit(text, width, color_codes):
     r"""Splits a string into two substrings, respecting involved color codes.
 
@@ -165,6 +300,47 @@ def _strsplit(text, width, color_codes):
     return left, right, left_width
 
 
+def _strwrap(text, width, color_codes):
+    """Splits a string into substrings of given width of visible chars, as
+    _strsplit() called again on each right substring would, in one pass.
+
+    Returns a list of (substring, width of visible chars in substring).
+    """
+    parts = []
+    chunk = []
+    seen_colors = ''
+    chunk_width = 0
+    total_chars = len(text)
+    i = 0
+
+    while i < total_chars:
+        if text[i] == '\x1b':
+            for c in color_codes:
+                if text.startswith(c, i):
+                    seen_colors = '' if c == _Color.RESET else seen_colors + c
+                    chunk.append(c)
+                    i += len(c)
+                    break
+            else:  # not found
+                chunk.append(text[i])
+                i += 1
+            continue
+
+        if chunk_width >= width:
+            chunk.append(_Color.RESET if seen_colors else '')
+            parts.append((''.join(chunk), chunk_width))
+            chunk = [seen_colors]
+            chunk_width = 0
+        chunk.append(text[i])
+        chunk_width += 1 + int(unicodedata.east_asian_width(text[i]) in 'WF')
+        i += 1
+
+    if text:
+        chunk.append(_Color.RESET if seen_colors else '')
+        parts.append((''.join(chunk), chunk_width))
+    return parts
+
+
 def _strtrim(text, width, wrap_char, pad, color_codes):
     r"""Trims given string respecting the involved color codes (using
     strsplit), so that if text is larger than width, it's trimmed to have
@@ -226,6 +402,480 @@ def _word_diff(a: str, b: str) -> tuple:
     return ''.join(xs), ''.join(ys)
 
 
+# Pairs of lines to compare in a replaced block, beyond which the lines are
+# also compared by MinHash sketches of their shingles (see _LineDiffer)
+_SKETCH_MIN_PAIRS = 10000
+_SKETCH_SIZE = 16
+
+
+def _sketch(line: str) -> set:
+    """Bottom-k MinHash sketch of 3-byte shingles of the line, hashed with
+    crc32 which unlike hash() is stable across runs.
+    """
+    octets = line.encode('utf-8', 'surrogatepass')
+    hashes = {zlib.crc32(octets[i:i + 3]) for i in range(len(octets) - 2)}
+    return set(sorted(hashes)[:_SKETCH_SIZE])
+
+
+_ALGORITHMS = ('difflib', 'patience', 'histogram')
+_HISTOGRAM_MAX_COUNT = 64   # lines occurring more often are no anchors
+
+
+def _longest_increasing(anchors: list) -> list:
+    """Returns longest subsequence of anchors (i, j, 1), sorted by i, that
+    increases in j too, by patience sorting.
+    """
+    tails = []      # j of the top anchor of each pile
+    tops = []       # index of the top anchor of each pile
+    prev = []       # index of the anchor below in the previous pile
+    for k, (_, j, _) in enumerate(anchors):
+        pile = bisect.bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tops.append(k)
+        else:
+            tails[pile] = j
+            tops[pile] = k
+        prev.append(tops[pile - 1] if pile else None)
+    result = []
+    k = tops[-1] if tops else None
+    while k is not None:
+        result.append(anchors[k])
+        k = prev[k]
+    return result[::-1]
+
+
+def _patience_anchors(a, alo, ahi, b, blo, bhi) -> list:
+    """Returns anchors (i, j, 1) of lines occurring once in both ranges, the
+    longest run of them in the same order on both sides.
+    """
+    index = {}      # line -> index in a, or None if not unique
+    for i in range(alo, ahi):
+        index[a[i]] = None if a[i] in index else i
+    unique = {}     # line -> index in b, or None if not unique
+    for j in range(blo, bhi):
+        line = b[j]
+        if index.get(line) is not None:
+            unique[line] = None if line in unique else j
+    anchors = sorted((index[line], j, 1) for line, j in unique.items()
+                     if j is not None)
+    return _longest_increasing(anchors)
+
+
+def _histogram_anchors(a, alo, ahi, b, blo, bhi) -> list:
+    """Returns one anchor (i, j, n) of the longest common run around the
+    lines least frequent in range of a, like git's histogram diff.
+    """
+    where = collections.defaultdict(list)   # line -> indices in a
+    for i in range(alo, ahi):
+        where[a[i]].append(i)
+    best, best_count = None, _HISTOGRAM_MAX_COUNT + 1
+    j = blo
+    while j < bhi:
+        indices = where.get(b[j])
+        if not indices or len(indices) > best_count:
+            j += 1
+            continue
+        next_j = j + 1
+        for i in indices:
+            # Extend the match both ways, counting the rarest line in it
+            count = len(indices)
+            si, sj = i, j
+            while si > alo and sj > blo and a[si - 1] == b[sj - 1]:
+                si -= 1
+                sj -= 1
+                count = min(count, len(where[a[si]]))
+            ei, ej = i + 1, j + 1
+            while ei < ahi and ej < bhi and a[ei] == b[ej]:
+                count = min(count, len(where[a[ei]]))
+                ei += 1
+                ej += 1
+            next_j = max(next_j, ej)
+            if best is None or ei - si > best[2] or count < best_count:
+                best, best_count = (si, sj, ei - si), count
+        j = next_j
+    return [best] if best else []
+
+
+def _anchored_blocks(a: list, b: list, algorithm: str) -> list:
+    """Returns matching blocks of a and b as SequenceMatcher does, found by
+    splitting both at anchor lines picked with hash maps, then the ranges
+    between them in turn.  A range without anchors falls back to difflib.
+    """
+    find_anchors = (_patience_anchors if algorithm == 'patience' else
+                    _histogram_anchors)
+    matches = []    # (i, j) of equal lines
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        alo, ahi, blo, bhi = ranges.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = find_anchors(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+            for i, j, n in matcher.get_matching_blocks():
+                matches.extend((alo + i + k, blo + j + k) for k in range(n))
+            continue
+        for i, j, n in anchors:
+            ranges.append((alo, i, blo, j))
+            matches.extend((i + k, j + k) for k in range(n))
+            alo, blo = i + n, j + n
+        ranges.append((alo, ahi, blo, bhi))
+
+    blocks = []
+    for i, j in sorted(matches):
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and \
+                blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    blocks = [difflib.Match(*x) for x in blocks]
+    blocks.append(difflib.Match(len(a), len(b), 0))
+    return blocks
+
+
+class _AnchoredMatcher(difflib.SequenceMatcher):
+    """SequenceMatcher of lines whose matching blocks are anchored on unique
+    (patience) or rare (histogram) lines, in near-linear time where difflib
+    is superlinear and treats popular lines as junk.  Opcodes are derived
+    from the blocks by SequenceMatcher.
+    """
+
+    def __init__(self, a, b, algorithm):
+        self.a, self.b = a, b
+        self._algorithm = algorithm
+        self.matching_blocks = self.opcodes = None
+
+    def get_matching_blocks(self):
+        if self.matching_blocks is None:
+            self.matching_blocks = _anchored_blocks(self.a, self.b,
+                                                    self._algorithm)
+        return self.matching_blocks
+
+
+def _line_matcher(a, b, algorithm='difflib'):
+    """Returns SequenceMatcher of lines a and b with given algorithm"""
+    if algorithm == 'difflib':
+        return difflib.SequenceMatcher(None, a, b)
+    return _AnchoredMatcher(a, b, algorithm)
+
+
+class _LineDiffer(difflib.Differ):
+    """difflib.Differ with a configurable similarity cutoff for pairing lines
+    of a replaced block (hardcoded 0.75 in difflib).  Hopeless pairs are
+    rejected by cheap upper bounds of the similarity ratio before the full
+    SequenceMatcher alignment, counts are recorded in stats.  Lines are
+    matched by given algorithm, see _line_matcher().
+    """
+
+    def __init__(self, similarity=0.75, stats=None, algorithm='difflib'):
+        difflib.Differ.__init__(self, charjunk=difflib.IS_CHARACTER_JUNK)
+        self._similarity = similarity
+        self._algorithm = algorithm
+        self._stats = collections.Counter() if stats is None else stats
+        # Char counts and sketches by line, _fancy_replace() recurses on the
+        # same lines many times
+        self._chars = {}
+        self._sketches = {}
+
+    def compare(self, a, b):
+        """Same as Differ.compare(), but with lines matched by algorithm"""
+        cruncher = _line_matcher(a, b, self._algorithm)
+        for tag, alo, ahi, blo, bhi in cruncher.get_opcodes():
+            if tag == 'replace':
+                g = self._fancy_replace(a, alo, ahi, b, blo, bhi)
+            elif tag == 'delete':
+                g = self._dump('-', a, alo, ahi)
+            elif tag == 'insert':
+                g = self._dump('+', b, blo, bhi)
+            else:
+                g = self._dump(' ', a, alo, ahi)
+            for line in g:
+                yield line
+
+    def _get_chars(self, line):
+        chars = self._chars.get(line)
+        if chars is None:
+            chars = self._chars[line] = collections.Counter(line)
+        return chars
+
+    def _get_sketch(self, line):
+        sketch = self._sketches.get(line)
+        if sketch is None:
+            sketch = self._sketches[line] = _sketch(line)
+        return sketch
+
+    def _fancy_replace(self, a, alo, ahi, b, blo, bhi):
+        """Same as Differ._fancy_replace(), but the pair search tries ratio
+        bounds of increasing cost first: length ratio (same as
+        real_quick_ratio()), char multiset ratio (same as quick_ratio()) and,
+        for large blocks only, MinHash sketches.  Only the last one is a
+        heuristic, it rejects pairs sharing none of the sketched shingles.
+        """
+        best_ratio, cutoff = self._similarity - 0.01, self._similarity
+        cruncher = difflib.SequenceMatcher(self.charjunk)
+        eqi, eqj = None, None   # 1st indices of equal lines (if any)
+        use_sketch = (ahi - alo) * (bhi - blo) > _SKETCH_MIN_PAIRS
+        lengths = {i: len(a[i]) for i in range(alo, ahi)}
+        by_length = sorted(range(alo, ahi), key=lengths.__getitem__)
+        sorted_lengths = [lengths[i] for i in by_length]
+        if use_sketch:
+            sketches = {i: self._get_sketch(a[i]) for i in range(alo, ahi)}
+        pruned = collections.Counter()
+
+        for j in range(blo, bhi):
+            bj = b[j]
+            lb = len(bj)
+            bchars = None
+            bsketch = self._get_sketch(bj) if use_sketch else None
+            cruncher_ready = False
+            # Lengths for which the length ratio might beat best_ratio, with
+            # slack for rounding, exact check below
+            low = best_ratio * lb / (2.0 - best_ratio) - 1
+            high = (lb * (2.0 - best_ratio) / best_ratio + 1
+                    if best_ratio > 0 else float('inf'))
+            candidates = sorted(by_length[
+                bisect.bisect_right(sorted_lengths, low):
+                bisect.bisect_left(sorted_lengths, high)])
+            pruned['length'] += (ahi - alo) - len(candidates)
+            for i in candidates:
+                ai = a[i]
+                if ai == bj:
+                    if eqi is None:
+                        eqi, eqj = i, j
+                    pruned['identical'] += 1
+                    continue
+                total = lengths[i] + lb
+                if 2.0 * min(lengths[i], lb) / total <= best_ratio:
+                    pruned['length'] += 1
+                    continue
+                if use_sketch and sketches[i] and bsketch and \
+                        sketches[i].isdisjoint(bsketch):
+                    pruned['sketch'] += 1
+                    continue
+                if bchars is None:
+                    bchars = self._get_chars(bj)
+                achars = self._get_chars(ai)
+                matches = sum(min(achars[c], bchars[c])
+                              for c in achars.keys() & bchars.keys())
+                if 2.0 * matches / total <= best_ratio:
+                    pruned['chars'] += 1
+                    continue
+                pruned['ratio'] += 1
+                if not cruncher_ready:
+                    cruncher.set_seq2(bj)
+                    cruncher_ready = True
+                cruncher.set_seq1(ai)
+                if cruncher.ratio() > best_ratio:
+                    best_ratio, best_i, best_j = cruncher.ratio(), i, j
+
+        # Identical pairs are not candidates, others are either pruned or
+        # compared by ratio()
+        candidates = (ahi - alo) * (bhi - blo) - pruned.pop('identical', 0)
+        self._stats['pair.candidates'] += candidates
+        self._stats['pair.ratio_computed'] += pruned.pop('ratio', 0)
+        for key, count in pruned.items():
+            self._stats['pair.pruned_by_' + key] += count
+
+        if best_ratio < cutoff:
+            # no non-identical "pretty close" pair
+            if eqi is None:
+                # no identical pair either -- treat it as a straight replace
+                for line in self._plain_replace(a, alo, ahi, b, blo, bhi):
+                    yield line
+                return
+            # no close pair, but an identical pair -- synch up on that
+            best_i, best_j, best_ratio = eqi, eqj, 1.0
+        else:
+            # there's a close pair, so forget the identical pair (if any)
+            eqi = None
+
+        for line in self._fancy_helper(a, alo, best_i, b, blo, best_j):
+            yield line
+
+        # do intraline marking on the synch pair
+        aelt, belt = a[best_i], b[best_j]
+        if eqi is None:
+            atags = btags = ''
+            cruncher.set_seqs(aelt, belt)
+            for tag, ai1, ai2, bj1, bj2 in cruncher.get_opcodes():
+                la, lb = ai2 - ai1, bj2 - bj1
+                if tag == 'replace':
+                    atags += '^' * la
+                    btags += '^' * lb
+                elif tag == 'delete':
+                    atags += '-' * la
+                elif tag == 'insert':
+                    btags += '+' * lb
+                elif tag == 'equal':
+                    atags += ' ' * la
+                    btags += ' ' * lb
+            for line in self._qformat(aelt, belt, atags, btags):
+                yield line
+        else:
+            # the synch pair is identical
+            yield '  ' + aelt
+
+        for line in self._fancy_helper(a, best_i + 1, ahi, b, best_j + 1,
+                                       bhi):
+            yield line
+
+
+def _mdiff(fromlines, tolines, differ):
+    r"""Port of difflib._mdiff() without context support, yields the same
+    (from line, to line, changed) tuples, but takes the Differ that produces
+    ndiff lines.  Pending lines are kept in deques, difflib pops them from
+    the head of lists which is quadratic on large one-sided blocks.
+    """
+    change_re = re.compile(r'(\++|\-+|\^+)')
+    diff_lines = differ.compare(fromlines, tolines)
+    num_lines = [0, 0]
+
+    def _make_line(lines, format_key, side):
+        num_lines[side] += 1
+        if format_key is None:
+            return num_lines[side], lines.pop(0)[2:]
+        if format_key == '?':
+            # intraline changes, indices obtained from the second line
+            text, markers = lines.pop(0), lines.pop(0)
+            spans = [(m.group(1)[0], m.span())
+                     for m in change_re.finditer(markers)]
+            for key, (begin, end) in reversed(spans):
+                text = (text[0:begin] + '\0' + key + text[begin:end] + '\1' +
+                        text[end:])
+            text = text[2:]
+        else:
+            # add/delete entire line
+            text = lines.pop(0)[2:] or ' '
+            text = '\0' + format_key + text + '\1'
+        return num_lines[side], text
+
+    def _line_iterator():
+        lines = []
+        num_blanks_pending, num_blanks_to_yield = 0, 0
+        while True:
+            # Look ahead 4 lines, compare the concatenation of their first
+            # chars against patterns below
+            while len(lines) < 4:
+                lines.append(next(diff_lines, 'X'))
+            s = ''.join([line[0] for line in lines])
+            if s.startswith('X'):
+                # No more lines, pump out remaining blank lines
+                num_blanks_to_yield = num_blanks_pending
+            elif s.startswith('-?+?'):
+                yield (_make_line(lines, '?', 0), _make_line(lines, '?', 1),
+                       True)
+                continue
+            elif s.startswith('--++'):
+                num_blanks_pending -= 1
+                yield _make_line(lines, '-', 0), None, True
+                continue
+            elif s.startswith(('--?+', '--+', '- ')):
+                from_line, to_line = _make_line(lines, '-', 0), None
+                num_blanks_to_yield = num_blanks_pending - 1
+                num_blanks_pending = 0
+            elif s.startswith('-+?'):
+                yield (_make_line(lines, None, 0), _make_line(lines, '?', 1),
+                       True)
+                continue
+            elif s.startswith('-?+'):
+                yield (_make_line(lines, '?', 0), _make_line(lines, None, 1),
+                       True)
+                continue
+            elif s.startswith('-'):
+                num_blanks_pending -= 1
+                yield _make_line(lines, '-', 0), None, True
+                continue
+            elif s.startswith('+--'):
+                num_blanks_pending += 1
+                yield None, _make_line(lines, '+', 1), True
+                continue
+            elif s.startswith(('+ ', '+-')):
+                from_line, to_line = None, _make_line(lines, '+', 1)
+                num_blanks_to_yield = num_blanks_pending + 1
+                num_blanks_pending = 0
+            elif s.startswith('+'):
+                num_blanks_pending += 1
+                yield None, _make_line(lines, '+', 1), True
+                continue
+            elif s.startswith(' '):
+                yield (_make_line(lines[:], None, 0),
+                       _make_line(lines, None, 1), False)
+                continue
+            # Catch up on the blank lines so that next from/to pair lines up
+            while num_blanks_to_yield < 0:
+                num_blanks_to_yield += 1
+                yield None, ('', '\n'), True
+            while num_blanks_to_yield > 0:
+                num_blanks_to_yield -= 1
+                yield ('', '\n'), None, True
+            if s.startswith('X'):
+                return
+            yield from_line, to_line, True
+
+    from_lines = collections.deque()
+    to_lines = collections.deque()
+    for from_line, to_line, found_diff in _line_iterator():
+        if from_line is not None:
+            from_lines.append((from_line, found_diff))
+        if to_line is not None:
+            to_lines.append((to_line, found_diff))
+        while from_lines and to_lines:
+            from_line, from_diff = from_lines.popleft()
+            to_line, to_diff = to_lines.popleft()
+            yield from_line, to_line, from_diff or to_diff
+
+
+def _strip_markers(text: str) -> str:
+    r"""Removes the markers (\0-, \0+, \0^, \1) from text, see Hunk.mdiff()"""
+    for token in ['\0-', '\0+', '\0^', '\1']:
+        text = text.replace(token, '')
+    return text
+
+
+class Row:
+    """A row of aligned lines of a hunk, which renderers consume
+
+    old_num/new_num -- line number relative to hunk start, or '' for no line
+    kind -- 'common', 'old' (deleted), 'new' (added) or 'changed'
+    old_text/new_text -- line text without markers, or '' for no line
+    """
+
+    __slots__ = ('old_num', 'new_num', 'kind', 'old_text', 'new_text',
+                 '_word_diffs')
+
+    def __init__(self, old_num, new_num, kind, old_text, new_text):
+        self.old_num = old_num
+        self.new_num = new_num
+        self.kind = kind
+        self.old_text = old_text
+        self.new_text = new_text
+        self._word_diffs = None
+
+    def word_diff(self, normalize=None):
+        """Returns texts of a 'changed' row with word differences marked by
+        _word_diff(), after normalized by given function.  The result is kept
+        for each normalize function.
+        """
+        if self._word_diffs is None:
+            self._word_diffs = {}
+        marked = self._word_diffs.get(normalize)
+        if marked is None:
+            a, b = self.old_text, self.new_text
+            if normalize is not None:
+                a, b = normalize(a), normalize(b)
+            marked = self._word_diffs[normalize] = _word_diff(a, b)
+        return marked
+
+
 class Hunk:
 
     def __init__(self, hunk_headers, hunk_meta, old_addr, new_addr):
@@ -234,16 +884,45 @@ class Hunk:
         self._old_addr = old_addr   # tuple (start, offset)
         self._new_addr = new_addr   # tuple (start, offset)
         self._hunk_list = []        # list of tuple (attr, line)
+        self._eof_markers = {}      # index in _hunk_list: '\ No newline' line
+        self._old_count = 0         # number of '-' and ' ' lines
+        self._new_count = 0         # number of '+' and ' ' lines
+        self._rows = None           # tuple (params, list of Row)
 
     def append(self, hunk_line):
         """hunk_line is a 2-element tuple: (attr, text), where attr is:
                 '-': old, '+': new, ' ': common
         """
         self._hunk_list.append(hunk_line)
+        if hunk_line[0] != '+':
+            self._old_count += 1
+        if hunk_line[0] != '-':
+            self._new_count += 1
+        self._rows = None
+
+    def mark_eof(self, marker):
+        """Marks last line as the last of a file without newline at end, to
+        write the marker line ('\\ No newline at end of file') after it.
+        """
+        self._eof_markers[len(self._hunk_list) - 1] = marker
+
+    def __getstate__(self):
+        # Rows are aligned again in a worker process, see
+        # DiffMarker._render_hunks(), and refer to renderers of this process
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        return state
+
+    def is_one_sided(self):
+        """Hunk of only deleted or only added lines, e.g. from a new or
+        deleted file, has nothing to align.
+        """
+        return not self._old_count or not self._new_count
 
-    def mdiff(self):
-        r"""The difflib._mdiff() function returns an interator which returns a
-        tuple: (from line tuple, to line tuple, boolean flag)
+    def mdiff(self, similarity=0.75, stats=None, algorithm='difflib'):
+        r"""The _mdiff() function (port of difflib._mdiff()) returns an
+        interator which returns a tuple: (from line tuple, to line tuple,
+        boolean flag)
 
         from/to line tuple -- (line num, line text)
             line num -- integer or None (to indicate a context separation)
@@ -255,8 +934,84 @@ class Hunk:
 
         boolean flag -- None indicates context separation, True indicates
             either "from" or "to" line contains a change, otherwise False.
+
+        A deleted and an added line are paired as a change only if their
+        similarity ratio is at least given similarity, see _LineDiffer.
+        Lines of each change block between common lines are aligned
+        separately, see _blocks(), and matched by given algorithm.
+        """
+        differ = _LineDiffer(similarity, stats, algorithm)
+        old_num = new_num = 0
+        for attr, lines in self._blocks():
+            if attr == ' ':
+                for _, line in lines:
+                    old_num += 1
+                    new_num += 1
+                    yield (old_num, line), (new_num, line), False
+                continue
+            old = [line for (a, line) in lines if a == '-']
+            new = [line for (a, line) in lines if a == '+']
+            if not old or not new:
+                # Nothing to align, as _mdiff() marks added/deleted lines
+                pairs = (((i, '\0-%s\1' % (a or ' ')), ('', '\n'), True)
+                         for i, a in enumerate(old, 1))
+                pairs = itertools.chain(pairs, (
+                    (('', '\n'), (j, '\0+%s\1' % (b or ' ')), True)
+                    for j, b in enumerate(new, 1)))
+            else:
+                pairs = _mdiff(old, new, differ)
+            for (i, a), (j, b), changed in pairs:
+                yield ((i and i + old_num, a), (j and j + new_num, b),
+                       changed)
+            old_num += len(old)
+            new_num += len(new)
+
+    def _blocks(self):
+        """Splits hunk at common lines, yields (attr, lines) of a run of
+        common lines with attr ' ', or of a change block with attr '-'.
+        Common lines are aligned already, only change blocks are given to
+        _mdiff() each on its own.
         """
-        return difflib._mdiff(self._get_old_text(), self._get_new_text())
+        for common, lines in itertools.groupby(self._hunk_list,
+                                               lambda x: x[0] == ' '):
+            yield (' ' if common else '-'), list(lines)
+
+    def rows(self, similarity=0.75, stats=None, algorithm='difflib'):
+        """Returns list of Row from mdiff(), aligned once for renderers of
+        the hunk with the same similarity and algorithm.
+        """
+        params = (similarity, algorithm)
+        if self._rows is not None and self._rows[0] == params:
+            return self._rows[1]
+        if self.is_one_sided():
+            rows = self._one_sided_rows()
+            if stats is not None:
+                stats['hunk.one_sided'] += 1
+            self._rows = (params, rows)
+            return rows
+        rows = []
+        for old, new, changed in self.mdiff(similarity, stats, algorithm):
+            if not changed:
+                kind = 'common'
+            elif not old[0]:
+                kind = 'new'
+            elif not new[0]:
+                kind = 'old'
+            else:
+                kind = 'changed'
+            old_text = _strip_markers(old[1]) if old[0] else ''
+            new_text = _strip_markers(new[1]) if new[0] else ''
+            rows.append(Row(old[0], new[0], kind, old_text, new_text))
+        self._rows = (params, rows)
+        return rows
+
+    def _one_sided_rows(self):
+        # Same rows as mdiff() gives, empty text becomes ' ' there as well
+        if self._old_count:
+            return [Row(i, '', 'old', line or ' ', '')
+                    for i, (_, line) in enumerate(self._hunk_list, 1)]
+        return [Row('', i, 'new', '', line or ' ')
+                for i, (_, line) in enumerate(self._hunk_list, 1)]
 
     def _get_old_text(self):
         return [line for (attr, line) in self._hunk_list if attr != '+']
@@ -265,9 +1020,8 @@ class Hunk:
         return [line for (attr, line) in self._hunk_list if attr != '-']
 
     def is_completed(self):
-        old_completed = self._old_addr[1] == len(self._get_old_text())
-        new_completed = self._new_addr[1] == len(self._get_new_text())
-        return old_completed and new_completed
+        return (self._old_addr[1] == self._old_count and
+                self._new_addr[1] == self._new_count)
 
 
 class UnifiedDiff:
@@ -338,18 +1092,80 @@ class UnifiedDiff:
         return re.match('^Binary files .* differ$', line.rstrip())
 
 
+# Hunk lines to look ahead to detect encoding of a file, see
+# DiffParser._detect_encoding()
+_DETECT_LINES = 1000
+
+
+def _is_hunk_line(octets):
+    """Tells if a line (in bytes) looks like an old, new or common line"""
+    return (octets[:1] in (b' ', b'+', b'-') and
+            octets[:4] not in (b'--- ', b'+++ '))
+
+
 class DiffParser:
 
-    def __init__(self, stream):
+    def __init__(self, stream, encoding=None):
         self._stream = stream  # bytes
+        self._given = encoding
+        self._encoding = 'utf-8'    # of current file
+        self._detected = False
+        self._pending = collections.deque()     # lines looked ahead
+
+    def _lines(self):
+        """Yields lines of the stream, including those looked ahead"""
+        self._it = iter(self._stream)
+        for octets in self._it:
+            yield octets
+            while self._pending:
+                yield self._pending.popleft()
+
+    def _decode(self, octets):
+        """Decodes hunk lines with encoding of current file, other lines (e.g.
+        paths) could be in another encoding so they are decoded by _decode().
+        A utf-8 file turns latin-1 from the first hunk line not in utf-8.
+        """
+        if self._given:
+            return octets.decode(self._given, 'replace')
+        if self._encoding == 'utf-8':
+            try:
+                return octets.decode('utf-8')
+            except UnicodeDecodeError:
+                if _is_hunk_line(octets):
+                    self._encoding = 'latin-1'
+                return octets.decode('latin-1')
+        if _is_hunk_line(octets):
+            return octets.decode(self._encoding)
+        return _decode(octets)
+
+    def _new_file(self):
+        """Forget encoding detected for previous file"""
+        self._encoding = 'utf-8'
+        self._detected = False
+
+    def _detect_encoding(self, hunk):
+        """Detects encoding of current file from the first lines (up to
+        _DETECT_LINES) of its first hunk, which are read ahead and kept to be
+        parsed.  A hunk has at least as many lines as the larger of its old
+        and new line counts, so the lines never go beyond the file.  The file
+        is utf-8 if they decode as utf-8, otherwise latin-1, which never fails
+        to decode.
+        """
+        self._detected = True
+        count = min(max(hunk._old_addr[1], hunk._new_addr[1]), _DETECT_LINES)
+        self._pending.extend(itertools.islice(self._it, count))
+        try:
+            b''.join(self._pending).decode('utf-8')
+        except UnicodeDecodeError:
+            self._encoding = 'latin-1'
 
     def parse(self):
         """parse all diff lines, construct a list of UnifiedDiff objects"""
         diff = UnifiedDiff([], None, None, [])
         headers = []
 
-        for octets in self._stream:
-            line = _decode(octets)
+        for octets in self._lines():
+            line = self._decode(octets)
 
             if diff.is_old_path(line):
                 # This is a new diff when current hunk is not yet genreated or
@@ -361,6 +1177,7 @@ class DiffParser:
                         yield diff
                     diff = UnifiedDiff(headers, line, None, [])
                     headers = []
+                    self._new_file()
                 else:
                     diff._hunks[-1].append(diff.parse_hunk_line(line))
 
@@ -378,6 +1195,8 @@ class DiffParser:
                 hunk = Hunk(headers, line, old_addr, new_addr)
                 headers = []
                 diff._hunks.append(hunk)
+                if not self._detected and not self._given:
+                    self._detect_encoding(hunk)
 
             elif diff._hunks and not headers and (diff.is_old(line) or
                                                   diff.is_new(line) or
@@ -385,7 +1204,8 @@ class DiffParser:
                 diff._hunks[-1].append(diff.parse_hunk_line(line))
 
             elif diff.is_eof(line):
-                pass
+                if diff._hunks and not headers:
+                    diff._hunks[-1].mark_eof(line)
 
             elif diff.is_only_in_dir(line) or diff.is_binary_differ(line):
                 # 'Only in foo:' and 'Binary files ... differ' are considered
@@ -397,9 +1217,13 @@ class DiffParser:
                 yield UnifiedDiff(headers, '', '', [])
                 headers = []
                 diff = UnifiedDiff([], None, None, [])
+                self._new_file()
 
             else:
-                # Non-recognized lines: headers or hunk headers
+                # Non-recognized lines: headers or hunk headers, which are not
+                # in encoding of current file, e.g. message of next commit
+                if self._encoding != 'utf-8' and not self._given:
+                    line = _decode(octets)
                 headers.append(line)
 
         # Validate and yield the last patch set if it is not yielded yet
@@ -415,27 +1239,160 @@ class DiffParser:
             yield UnifiedDiff(headers, '', '', [])
 
 
+class _LRUCache:
+    """Mapping bounded by total size of values, least recently used entries
+    are evicted first.  Hits, misses and evictions are counted in stats with
+    given name as prefix.
+    """
+
+    def __init__(self, capacity, stats, name):
+        self._capacity = capacity
+        self._stats = stats
+        self._name = name
+        self._size = 0
+        self._entries = collections.OrderedDict()   # key: (value, size)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats[self._name + '.misses'] += 1
+            return None
+        self._stats[self._name + '.hits'] += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self._capacity:
+            return
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self._capacity:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= evicted
+            self._stats[self._name + '.evictions'] += 1
+
+
+# Upper limit of rendered lines kept by DiffMarker to reuse for hunks with the
+# same body, e.g. a license header update across many files
+_HUNK_CACHE_SIZE = 20000
+_FRAGMENT_CACHE_SIZE = 4096     # rendered common lines
+_FRAGMENT_MAX_TEXT = 80         # longer common lines are rarely repeated
+
+# Globs of paths of generated files, see _is_generated()
+_GENERATED_PATHS = (
+    '*.lock', 'package-lock.json', 'pnpm-lock.yaml', 'go.sum', '*.min.js',
+    '*.min.css', '*.js.map', '*.css.map', '*.pb.go', '*_pb2.py', '*.snap',
+)
+_GENERATED_LINE_WIDTH = 1000    # no one writes a longer line by hand
+_GENERATED_LINES = 20000        # hunk lines of a file, too many to read
+
+
+def _is_generated(diff, patterns) -> bool:
+    """Tells whether diff is likely of a generated file, by path, by line
+    width, or by size of hunks.  Such a file is not worth marking up.
+    """
+    for line in (diff._old_path, diff._new_path):
+        # Globs match trailing parts of path, to ignore e.g. 'b/' of git
+        parts = _path_of(line).split('/')
+        for i in range(len(parts)):
+            tail = '/'.join(parts[i:])
+            if any(fnmatch.fnmatchcase(tail, p) for p in patterns):
+                return True
+    lines = 0
+    for hunk in diff._hunks:
+        lines += len(hunk._hunk_list)
+        if lines > _GENERATED_LINES:
+            return True
+        widest = max([len(text) for (_, text) in hunk._hunk_list] or [0])
+        if widest > _GENERATED_LINE_WIDTH:
+            return True
+    return False
+
+
 class DiffMarker:
 
     def __init__(self, side_by_side=False, width=0, tab_width=8, wrap=False,
-                 theme='default'):
+                 theme='default', similarity=0.75, stats=None,
+                 cache_size=_HUNK_CACHE_SIZE, color=True, terminal=None,
+                 generated=_GENERATED_PATHS, algorithm='difflib', jobs=1,
+                 threads=False):
         self._side_by_side = side_by_side
         self._width = width
+        self._terminal = terminal or _Terminal()
         self._tab_width = tab_width
         self._wrap = wrap
         self._theme = theme
-        self._tint = lambda s, k: _colorize(s, k, theme=theme)
-        self._codes = set(sum(_THEMES[theme].values(), []))
+        self._similarity = similarity
+        self._algorithm = algorithm
+        self._stats = collections.Counter() if stats is None else stats
+        if color:
+            self._tint = lambda s, k: _colorize(s, k, theme=theme)
+            self._codes = set(sum(_THEMES[theme].values(), ()))
+            self._reset = _Color.RESET
+        else:
+            self._tint = lambda s, k: _strip_markers(s)
+            self._codes = set()
+            self._reset = ''
+        self._cache = None
+        if cache_size > 0:
+            self._cache = _LRUCache(cache_size, self._stats, 'hunk_cache')
+        self._fragments = _LRUCache(_FRAGMENT_CACHE_SIZE, self._stats,
+                                    'fragment_cache')
+        self._generated = generated     # None to mark up all files
+        self._jobs = jobs
+        self._threads = threads     # workers are threads, not processes
+        self._pool = None
+        self._local = threading.local()
+        # To set up the same marker in worker processes, see _render_hunks()
+        self._worker_params = dict(
+            side_by_side=side_by_side, width=width, tab_width=tab_width,
+            wrap=wrap, theme=theme, similarity=similarity,
+            cache_size=cache_size, color=color, generated=generated,
+            algorithm=algorithm)
+
+    def close(self):
+        """Shuts down worker processes, if any"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
 
     def markup(self, diff):
         """Returns a generator"""
-        if self._side_by_side:
-            it = self._markup_side_by_side
+        summary = self._collapsed(diff)
+        if summary:
+            it = self._markup_collapsed(diff, summary)
+        elif self._side_by_side:
+            it = self._markup_side_by_side(diff)
         else:
-            it = self._markup_unified
-        for line in it(diff):
+            it = self._markup_unified(diff)
+        for line in it:
             yield line
 
+    def _rows_of(self, hunk):
+        return hunk.rows(self._similarity, self._stats, self._algorithm)
+
+    def _collapsed(self, diff):
+        """Returns summary line in place of hunks of a generated file, or
+        None to mark up the hunks.
+        """
+        if self._generated is None or not _is_generated(diff,
+                                                        self._generated):
+            return None
+        self._stats['diff.collapsed'] += 1
+        changed = sum(1 for hunk in diff._hunks
+                      for (attr, _) in hunk._hunk_list if attr != ' ')
+        return '%d lines changed, rendering skipped\n' % changed
+
+    def _markup_collapsed(self, diff, summary):
+        """Returns a generator"""
+        for line in diff._headers:
+            yield self._tint(line, 'header')
+        yield self._tint(diff._old_path, 'old_path')
+        yield self._tint(diff._new_path, 'new_path')
+        yield self._tint(summary, 'hunk_meta')
+
     def _markup_unified(self, diff):
         """Returns a generator"""
         for line in diff._headers:
@@ -444,44 +1401,95 @@ class DiffMarker:
         yield self._tint(diff._old_path, 'old_path')
         yield self._tint(diff._new_path, 'new_path')
 
-        for hunk in diff._hunks:
+        for hunk, lines in self._render_hunks(diff._hunks,
+                                              self._render_unified):
             for hunk_header in hunk._hunk_headers:
                 yield self._tint(hunk_header, 'hunk_header')
             yield self._tint(hunk._hunk_meta, 'hunk_meta')
-            for old, new, changed in hunk.mdiff():
-                if changed:
-                    if not old[0]:
-                        # The '+' char after \0 is kept
-                        # DEBUG: yield 'NEW: %s %s\n' % (old, new)
-                        line = new[1].strip('\0\1')
-                        yield self._tint(line, 'new_line')
-                    elif not new[0]:
-                        # The '-' char after \0 is kept
-                        # DEBUG: yield 'OLD: %s %s\n' % (old, new)
-                        line = old[1].strip('\0\1')
-                        yield self._tint(line, 'old_line')
-                    else:
-                        # DEBUG: yield 'CHG: %s %s\n' % (old, new)
-                        a, b = _word_diff(old[1], new[1])
-                        yield (self._tint('-', 'old_line') +
-                               self._tint(a, 'replaced_old_text'))
-                        yield (self._tint('+', 'new_line') +
-                               self._tint(b, 'replaced_new_text'))
-                else:
-                    yield self._tint(' ' + old[1], 'common_line')
+            for line in lines:
+                yield line
+
+    def _render_unified(self, hunk):
+        """Returns list of output lines of hunk body"""
+        lines = []
+        for row in self._rows_of(hunk):
+            if row.kind == 'new':
+                lines.append(self._tint('+' + row.new_text, 'new_line'))
+            elif row.kind == 'old':
+                lines.append(self._tint('-' + row.old_text, 'old_line'))
+            elif row.kind == 'changed':
+                a, b = row.word_diff()
+                lines.append(self._tint('-', 'old_line') +
+                             self._tint(a, 'replaced_old_text'))
+                lines.append(self._tint('+', 'new_line') +
+                             self._tint(b, 'replaced_new_text'))
+            else:
+                lines.append(self._tint(' ' + row.old_text, 'common_line'))
+        return lines
+
+    def _render(self, hunk, render_fn, *params):
+        """Returns render_fn(hunk, *params), reused for hunks with the same
+        body.  What render_fn returns must not depend on the hunk address.
+        """
+        if self._cache is None:
+            return render_fn(hunk, *params)
+        body = repr(hunk._hunk_list).encode('utf-8', 'surrogatepass')
+        key = (hashlib.sha1(body).digest(), render_fn.__name__) + params
+        rendered = self._cache.get(key)
+        if rendered is None:
+            rendered = render_fn(hunk, *params)
+            self._cache.put(key, rendered, len(rendered))
+        return rendered
+
+    def _render_hunks(self, hunks, render_fn, params_fn=tuple):
+        """Yields (hunk, _render() of hunk) for hunks in order, params_fn()
+        gives the params when the hunk is about to be rendered.  With jobs >
+        1, hunks of a file are rendered ahead in a pool of worker processes
+        or threads, and each is yielded as soon as it and those before it are
+        done.  A worker renders by a marker of its own, so caches and stats
+        are never shared by workers.
+        """
+        if self._jobs <= 1 or len(hunks) < 2:
+            for hunk in hunks:
+                yield hunk, self._render(hunk, render_fn, *params_fn())
+            return
+        if self._pool is None and self._threads:
+            self._pool = ThreadPoolExecutor(self._jobs)
+        elif self._pool is None:
+            self._pool = ProcessPoolExecutor(self._jobs)
+        if self._threads:
+            worker_fn = functools.partial(self._render_in_thread,
+                                          render_fn.__name__)
+        else:
+            worker_fn = functools.partial(
+                _render_in_worker, (type(self), self._worker_params),
+                render_fn.__name__)
+        items = ((hunk, params_fn()) for hunk in hunks)
+        results = _ordered_map(worker_fn, items, self._pool, self._jobs * 2)
+        for hunk, (rendered, stats) in zip(hunks, results):
+            self._stats.update(stats)
+            yield hunk, rendered
+
+    def _render_in_thread(self, name, item):
+        """Renders an item in a worker thread, see _render_in_worker()"""
+        marker = getattr(self._local, 'marker', None)
+        if marker is None:
+            marker = self._local.marker = type(self)(**self._worker_params)
+        return _render_by(marker, name, item)
 
     def _normalize(self, line):
-        index = 0
-        while True:
-            index = line.find('\t', index)
-            if index == -1:
-                break
-            # ignore special codes
-            offset = (line.count('\0', 0, index) * 2 +
-                      line.count('\1', 0, index))
-            # next stop modulo tab width
-            width = self._tab_width - (index - offset) % self._tab_width
-            line = line[:index] + ' ' * width + line[(index + 1):]
+        if '\t' in line:
+            pieces = line.split('\t')
+            column = 0
+            for i, piece in enumerate(pieces[:-1]):
+                # ignore special codes
+                column += (len(piece) - piece.count('\0') * 2 -
+                           piece.count('\1'))
+                # next stop modulo tab width
+                width = self._tab_width - column % self._tab_width
+                pieces[i] = piece + ' ' * width
+                column += width
+            line = ''.join(pieces)
         return line.replace('\n', '').replace('\r', '')
 
     def _markup_side_by_side(self, diff):
@@ -496,19 +1504,11 @@ class DiffMarker:
             max1 = max2 = 0
         num_width = max(len(str(max1)), len(str(max2)))
 
-        # Set up line width
-        width = self._width
-        if width <= 0:
-            # Autodetection of text width according to terminal size.  Each
-            # line is like 'nnn TEXT nnn TEXT\n', so width is half of terminal
-            # size minus the line number columns and 3 separating spaces
-            width = (_terminal_width() - num_width * 2 - 3) // 2
-
         # Setup lineno and line format
         num_fmt1 = self._tint('%%(left_num)%ds' % num_width, 'old_line_number')
         num_fmt2 = self._tint('%%(right_num)%ds' % num_width,
                               'new_line_number')
-        line_fmt = (num_fmt1 + ' %(left)s ' + _Color.RESET +
+        line_fmt = (num_fmt1 + ' %(left)s ' + self._reset +
                     num_fmt2 + ' %(right)s\n')
 
         # yield header, old path and new path
@@ -517,92 +1517,788 @@ class DiffMarker:
         yield self._tint(diff._old_path, 'old_path')
         yield self._tint(diff._new_path, 'new_path')
 
-        # yield hunks
-        for hunk in diff._hunks:
+        # yield hunks, text width is set up for each hunk to follow resizing
+        # of the terminal, rows of a hunk are aligned only once anyway
+        for hunk, rows in self._render_hunks(
+                diff._hunks, self._render_side_by_side,
+                lambda: (self._text_width(num_width),)):
             for hunk_header in hunk._hunk_headers:
                 yield self._tint(hunk_header, 'hunk_header')
             yield self._tint(hunk._hunk_meta, 'hunk_meta')
-            for old, new, changed in hunk.mdiff():
-                if old[0]:
-                    left_num = str(hunk._old_addr[0] + int(old[0]) - 1)
+            for left_num, left, right_num, right in rows:
+                yield line_fmt % {
+                    'left_num': _line_number(left_num, hunk._old_addr),
+                    'left': left,
+                    'right_num': _line_number(right_num, hunk._new_addr),
+                    'right': right
+                }
+
+    def _text_width(self, num_width):
+        if self._width > 0:
+            return self._width
+        # Autodetection of text width according to terminal size.  Each line
+        # is like 'nnn TEXT nnn TEXT\n', so width is half of terminal size
+        # minus the line number columns and 3 separating spaces
+        return (self._terminal.width() - num_width * 2 - 3) // 2
+
+    def _render_side_by_side(self, hunk, width):
+        """Returns list of output rows of hunk body, each is a tuple
+        (left line num, left text, right line num, right text) with line
+        numbers relative to hunk start and None for a wrapped part.
+        """
+        rows = []
+        for row in self._rows_of(hunk):
+            if row.kind == 'common':
+                parts = self._common_parts(row.old_text, width)
+            else:
+                if row.kind == 'new':
+                    left = ''
+                    right = self._tint(self._normalize(row.new_text),
+                                       'new_line')
+                elif row.kind == 'old':
+                    left = self._tint(self._normalize(row.old_text),
+                                      'old_line')
+                    right = ''
+                else:
+                    left, right = row.word_diff(self._normalize)
+                    left = self._tint(left, 'replaced_old_text')
+                    right = self._tint(right, 'replaced_new_text')
+                parts = self._split_parts(left, right, width)
+
+            # Line number is printed only for the first part
+            left_num, right_num = row.old_num, row.new_num
+            for left, right in parts:
+                rows.append((left_num, left, right_num, right))
+                left_num = right_num = None
+        return rows
+
+    def _common_parts(self, text, width):
+        """Returns _split_parts() of a common line, memoized for short lines
+        as blank lines, braces and 'end' repeat all over a diff.
+        """
+        if self._fragments is None or len(text) > _FRAGMENT_MAX_TEXT:
+            line = self._tint(self._normalize(text), 'common_line')
+            return self._split_parts(line, line, width)
+        key = (text, width)
+        parts = self._fragments.get(key)
+        if parts is None:
+            line = self._tint(self._normalize(text), 'common_line')
+            parts = self._split_parts(line, line, width)
+            self._fragments.put(key, parts, 1)
+        return parts
+
+    def _split_parts(self, left, right, width):
+        """Returns list of (left, right) parts of a side-by-side row in given
+        text width, the left padded to width.
+        """
+        if not self._wrap:
+            # Don't need to wrap long lines; instead, a trailing '>' char
+            # needs to be appended.
+            wrap_marker = self._tint('>', 'wrap_marker')
+            left = _strtrim(left, width, wrap_marker, len(right) > 0,
+                            self._codes)
+            right = _strtrim(right, width, wrap_marker, False, self._codes)
+            return [(left, right)]
+
+        # Need to wrap long lines, so here we'll shave off `width` chars from
+        # both left and right strings, preserving escaping sequences
+        # correctly, until both are empty.
+        parts = []
+        for (lcur, llen), (rcur, _) in itertools.zip_longest(
+                _strwrap(left, width, self._codes),
+                _strwrap(right, width, self._codes), fillvalue=('', 0)):
+            # Pad left line with spaces if needed
+            if llen < width:
+                lcur = '%s%*s' % (lcur, width - llen, '')
+
+            parts.append((lcur, rcur))
+        return parts
+
+
+def _line_number(num, addr):
+    """Returns line number column text of a side-by-side row, num is relative
+    to hunk start (addr), '' for no line or None for a wrapped part.
+    """
+    if num is None:
+        return ''
+    if not num:
+        return ' '
+    return str(addr[0] + int(num) - 1)
+
+
+# CSS colors of the ANSI color codes used in _THEMES, as in xterm
+_CSS_COLORS = {
+    '31': '#cd0000',
+    '32': '#00cd00',
+    '33': '#cdcd00',
+    '34': '#0000ee',
+    '36': '#00cdcd',
+    '95': '#ff00ff',
+    '96': '#00ffff',
+}
+
+
+def _xterm_color(index: int) -> str:
+    """Returns CSS color of a 256-color palette index (16 to 255)"""
+    if index >= 232:
+        level = 8 + (index - 232) * 10
+        return '#%02x%02x%02x' % (level, level, level)
+    levels = [0, 95, 135, 175, 215, 255]
+    index -= 16
+    return '#%02x%02x%02x' % (levels[index // 36], levels[index // 6 % 6],
+                              levels[index % 6])
+
+
+def _css(effects: list) -> str:
+    """Returns CSS declarations equivalent to ANSI effects of a theme kind"""
+    fg = bg = None
+    reverse = False
+    for effect in effects:
+        params = effect[2:-1].split(';')
+        if params[0] == '7':
+            reverse = True
+        elif params[0] == '38':
+            fg = _xterm_color(int(params[2]))
+        elif params[0] == '48':
+            bg = _xterm_color(int(params[2]))
+        elif params[0] in _CSS_COLORS:
+            fg = _CSS_COLORS[params[0]]
+    if reverse:
+        fg, bg = bg or '#fff', fg or '#000'
+    decls = []
+    if fg:
+        decls.append('color:%s' % fg)
+    if bg:
+        decls.append('background:%s' % bg)
+    return ';'.join(decls)
+
+
+def _css_class(kind: str) -> str:
+    """Returns CSS class of a kind in _THEMES, e.g. 'rot' for
+    'replaced_old_text', short to keep output of a large diff small.
+    """
+    return ''.join(word[0] for word in kind.split('_'))
+
+
+def _stylesheet(theme='default', tab_width=8):
+    """Returns the stylesheet shared by all elements output by HtmlMarker"""
+    rules = [
+        '.ydiff{border-collapse:collapse;width:100%;font-family:monospace}',
+        '.ydiff td{white-space:pre-wrap;word-break:break-all;'
+        'vertical-align:top;tab-size:%d}' % tab_width,
+        '.ydiff th{font-weight:normal;text-align:right;padding:0 .5em;'
+        'vertical-align:top;user-select:none}',
+        '.ydiff tr>th:first-child{%s}' % _css(
+            _THEMES[theme]['old_line_number']),
+        '.ydiff th+th,.ydiff td+th{%s}' % _css(
+            _THEMES[theme]['new_line_number']),
+        '.ydiff-sbs td{width:50%}',
+        'hr.fs{border:0;border-top:1px solid;%s}' % _css(
+            _THEMES[theme]['file_separator']),
+    ]
+    for kind, effects in sorted(_THEMES[theme].items()):
+        decls = _css(effects)
+        if decls and kind not in ('old_line_number', 'new_line_number',
+                                  'file_separator'):
+            rules.append('.%s{%s}' % (_css_class(kind), decls))
+    return '\n'.join(rules) + '\n'
+
+
+def _html_text(text, spans=None):
+    """Returns escaped text without line break, marked text (see
+    Hunk.mdiff()) is wrapped in a span of class from spans (op: class) or
+    unwrapped when spans is None.
+    """
+    text = text.replace('\n', '').replace('\r', '')
+    parts = []
+    for op, part in _spans(text):
+        part = html.escape(part, quote=False)
+        if op == '=' or spans is None:
+            parts.append(part)
+        else:
+            parts.append('<span class="%s">%s</span>' % (spans[op], part))
+    return ''.join(parts)
+
+
+class HtmlMarker(DiffMarker):
+    """Marks up a diff as an HTML table, styled by classes of _stylesheet()
+    instead of inline styles.  Long lines are wrapped by the browser.
+    """
+
+    _OLD_SPANS = {'-': 'rot', '^': 'dt'}
+    _NEW_SPANS = {'+': 'rnt', '^': 'it'}
+
+    def markup(self, diff):
+        """Returns a generator"""
+        layout = 'ydiff-sbs' if self._side_by_side else 'ydiff-unified'
+        yield '<table class="ydiff %s">\n' % layout
+        colspan = 4 if self._side_by_side else 3
+        for line in diff._headers:
+            yield self._full_row(line, 'h', colspan)
+        if diff._old_path:
+            yield self._full_row(diff._old_path, 'op', colspan)
+            yield self._full_row(diff._new_path, 'np', colspan)
+
+        summary = self._collapsed(diff)
+        if summary:
+            yield self._full_row(summary, 'hm', colspan)
+            yield '</table>\n'
+            return
+
+        if self._side_by_side:
+            render_fn = self._render_html_side_by_side
+            fmt = '<tr><th>%s%s<th>%s%s\n'
+        else:
+            render_fn = self._render_html_unified
+            fmt = '<tr><th>%s<th>%s%s\n'
+        for hunk, rows in self._render_hunks(diff._hunks, render_fn):
+            for hunk_header in hunk._hunk_headers:
+                yield self._full_row(hunk_header, 'hh', colspan)
+            yield self._full_row(hunk._hunk_meta, 'hm', colspan)
+            for old_num, new_num, cells in rows:
+                old_num = _line_number(old_num, hunk._old_addr).strip()
+                new_num = _line_number(new_num, hunk._new_addr).strip()
+                if self._side_by_side:
+                    yield fmt % (old_num, cells[0], new_num, cells[1])
                 else:
-                    left_num = ' '
+                    yield fmt % (old_num, new_num, cells[0])
+        yield '</table>\n'
+
+    def _full_row(self, line, css_class, colspan):
+        return '<tr><td colspan="%d" class="%s">%s\n' % (
+            colspan, css_class, _html_text(line))
 
-                if new[0]:
-                    right_num = str(hunk._new_addr[0] + int(new[0]) - 1)
+    def _render_html_side_by_side(self, hunk):
+        """Returns list of (old line num, new line num, cells), line numbers
+        are relative to hunk start.
+        """
+        rows = []
+        for row in self._rows_of(hunk):
+            if row.kind == 'new':
+                cells = ('<td>', '<td class="nl">' + _html_text(row.new_text))
+            elif row.kind == 'old':
+                cells = ('<td class="ol">' + _html_text(row.old_text), '<td>')
+            elif row.kind == 'changed':
+                a, b = row.word_diff()
+                cells = ('<td class="ol">' + _html_text(a, self._OLD_SPANS),
+                         '<td class="nl">' + _html_text(b, self._NEW_SPANS))
+            else:
+                cells = ('<td>' + _html_text(row.old_text),
+                         '<td>' + _html_text(row.new_text))
+            rows.append((row.old_num, row.new_num, cells))
+        return rows
+
+    def _render_html_unified(self, hunk):
+        """Returns list of (old line num, new line num, cells), line numbers
+        are relative to hunk start.
+        """
+        rows = []
+        for row in self._rows_of(hunk):
+            if row.kind in ('old', 'changed'):
+                if row.kind == 'changed':
+                    text = _html_text(row.word_diff()[0], self._OLD_SPANS)
                 else:
-                    right_num = ' '
-
-                left = self._normalize(old[1])
-                right = self._normalize(new[1])
-
-                if changed:
-                    if not old[0]:
-                        left = ''
-                        right = right.rstrip('\1')
-                        if right.startswith('\0+'):
-                            right = right[2:]
-                        right = self._tint(right, 'new_line')
-                    elif not new[0]:
-                        left = left.rstrip('\1')
-                        if left.startswith('\0-'):
-                            left = left[2:]
-                        left = self._tint(left, 'old_line')
-                        right = ''
-                    else:
-                        left, right = _word_diff(left, right)
-                        left = self._tint(left, 'replaced_old_text')
-                        right = self._tint(right, 'replaced_new_text')
+                    text = _html_text(row.old_text)
+                rows.append((row.old_num, '', ('<td class="ol">-' + text,)))
+            if row.kind in ('new', 'changed'):
+                if row.kind == 'changed':
+                    text = _html_text(row.word_diff()[1], self._NEW_SPANS)
                 else:
-                    left = self._tint(left, 'common_line')
-                    right = self._tint(right, 'common_line')
-
-                if self._wrap:
-                    # Need to wrap long lines, so here we'll iterate,
-                    # shaving off `width` chars from both left and right
-                    # strings, until both are empty. Also, line number needs to
-                    # be printed only for the first part.
-                    lncur = left_num
-                    rncur = right_num
-                    while left or right:
-                        # Split both left and right lines, preserving escaping
-                        # sequences correctly.
-                        lcur, left, llen = _strsplit(left, width, self._codes)
-                        rcur, right, _ = _strsplit(right, width, self._codes)
-
-                        # Pad left line with spaces if needed
-                        if llen < width:
-                            lcur = '%s%*s' % (lcur, width - llen, '')
-
-                        yield line_fmt % {
-                            'left_num': lncur,
-                            'left': lcur,
-                            'right_num': rncur,
-                            'right': rcur
-                        }
-
-                        # Clean line numbers for further iterations
-                        lncur = ''
-                        rncur = ''
+                    text = _html_text(row.new_text)
+                rows.append(('', row.new_num, ('<td class="nl">+' + text,)))
+            if row.kind == 'common':
+                rows.append((row.old_num, row.new_num,
+                             ('<td> ' + _html_text(row.old_text),)))
+        return rows
+
+
+# Marker of a worker process and the (marker class, params) it is made of,
+# see DiffMarker._render_hunks()
+_worker_marker = None
+_worker_setup = None
+
+
+def _render_by(marker, name, item):
+    """Returns (rendered, stats) of a (hunk, params) item rendered by method
+    of given name of marker, and stats counted meanwhile.
+    """
+    hunk, params = item
+    rendered = marker._render(hunk, getattr(marker, name), *params)
+    stats = collections.Counter(marker._stats)
+    marker._stats.clear()
+    return rendered, stats
+
+
+def _render_in_worker(setup, name, item):
+    """Renders an item in a worker process by a marker made of setup when
+    the process renders its first hunk (no pool initializer before Python
+    3.7), made again only if setup changes.
+    """
+    global _worker_marker, _worker_setup
+    if setup != _worker_setup:
+        marker_class, params = setup
+        _worker_marker = marker_class(**params)
+        _worker_setup = setup
+    return _render_by(_worker_marker, name, item)
+
+
+def _markup_diffs(diffs, marker, separator):
+    """Returns a generator, output a separation line between diffs"""
+    for i, diff in enumerate(diffs):
+        if i > 0:
+            yield separator
+        for line in marker.markup(diff):
+            yield line
+
+
+def _grep_diffs(diffs, pattern=None, path_pattern=None):
+    """Yields diffs with a path matching path_pattern, each with only the
+    hunks which have a deleted or added line matching pattern, a diff left
+    with no hunks is dropped.  Patterns are compiled regular expressions,
+    hunks dropped are never aligned or marked up.
+    """
+    for diff in diffs:
+        if path_pattern:
+            if diff._old_path:
+                names = [_path_of(diff._old_path), _path_of(diff._new_path)]
+            else:
+                names = diff._headers   # 'Only in' or 'Binary files'
+            if not any(path_pattern.search(name) for name in names):
+                continue
+        if pattern:
+            hunks = [hunk for hunk in diff._hunks
+                     if any(pattern.search(text)
+                            for attr, text in hunk._hunk_list if attr != ' ')]
+            if not hunks:
+                continue
+            diff = UnifiedDiff(diff._headers, diff._old_path, diff._new_path,
+                               hunks)
+        yield diff
+
+
+def _commit_ids(headers: list) -> list:
+    """Returns ids of commits whose header line (see 'commit' in _VCS_INFO)
+    is among given diff header lines.
+    """
+    ids = []
+    for line in headers:
+        m = _COMMIT_RE.match(line)
+        if m:
+            ids.append(next(x for x in m.groups() if x))
+    return ids
+
+
+def _limit_commits(stream, max_commits: int):
+    """Yields lines (in bytes) of a log stream up to the end of the first
+    max_commits commits.  The svn entry separator precedes the commit line so
+    it is held back until we know the next commit is wanted.
+    """
+    seen = 0
+    held = None
+    for line in stream:
+        if _COMMIT_BYTES_RE.match(line):
+            seen += 1
+            if seen > max_commits:
+                return
+        if held is not None:
+            yield held
+            held = None
+        if line.rstrip() == b'-' * 72:
+            held = line
+        else:
+            yield line
+    if held is not None:
+        yield held
+
+
+class _CommitCache:
+    """On-disk cache of marked up log output, one file per commit.  Commits
+    are immutable, so an entry keyed by commit id and render parameters never
+    goes stale.  Only hash ids are cached, svn revision numbers are not unique
+    across repositories.  With a terminal given, its width at the start of a
+    commit is part of the key, and a commit is not cached if the terminal is
+    resized while it is rendered.
+    """
+
+    def __init__(self, directory, params, terminal=None):
+        self._dir = directory
+        self._params = params
+        self._terminal = terminal
+        self._width = None      # terminal width of current commit
+
+    def _path(self, commit):
+        key = repr((__version__, self._params, self._width, commit))
+        return os.path.join(self._dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _terminal_width(self):
+        return self._terminal.width() if self._terminal else None
+
+    def get(self, commit):
+        try:
+            with open(self._path(commit), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def put(self, commit, text):
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self._dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            os.replace(tmp, self._path(commit))
+        except (IOError, OSError):
+            pass    # cache is best effort
+
+    def markup(self, diffs, marker, separator):
+        """Like _markup_diffs(), but output of a cached commit is reused and
+        its diffs are skipped, others are cached once completely rendered.
+        """
+        commit = None
+        cached = None
+        rendered = None
+        first = True
+        for diff in diffs:
+            ids = _commit_ids(diff._headers)
+            if ids:
+                if rendered and self._terminal_width() == self._width:
+                    self.put(commit, ''.join(rendered))
+                self._width = self._terminal_width()
+                commit = ' '.join(ids)
+                cacheable = re.match('[0-9a-f]{12,}', commit)
+                cached = self.get(commit) if cacheable else None
+                rendered = [] if cacheable and cached is None else None
+                if cached is not None:
+                    if not first:
+                        yield separator
+                    yield cached
+                    first = False
+            if cached is not None:
+                continue
+            if not first:
+                yield separator
+                if rendered:
+                    rendered.append(separator)
+            for line in marker.markup(diff):
+                yield line
+                if rendered is not None:
+                    rendered.append(line)
+            first = False
+        if rendered and self._terminal_width() == self._width:
+            self.put(commit, ''.join(rendered))
+
+
+def _spans(text: str) -> list:
+    r"""Splits a text with markers (see Hunk.mdiff()) into a list of [op,
+    text] pairs, op is '=' for unchanged text, '-', '+' or '^' for deleted,
+    added or changed text.
+    """
+    spans = []
+    for m in re.finditer('\0([-+^])([^\1]*)\1?|[^\0]+', text):
+        if m.group(1):
+            spans.append([m.group(1), m.group(2)])
+        else:
+            spans.append(['=', m.group(0)])
+    return spans
+
+
+def _path_of(line: str) -> str:
+    """Returns path from a '--- path' or '+++ path' line, with timestamp or
+    revision after tab removed.
+    """
+    return line[4:].rstrip('\r\n').split('\t', 1)[0]
+
+
+def _records(diffs, similarity=0.75, stats=None, algorithm='difflib'):
+    """Returns a generator of records (dicts) of diffs, one for each file,
+    hunk and row of aligned lines of a hunk.  Texts are as in the diff.
+    """
+    for diff in diffs:
+        yield {
+            'type': 'file',
+            'headers': diff._headers,
+            'old_path': _path_of(diff._old_path),
+            'new_path': _path_of(diff._new_path),
+        }
+        for hunk in diff._hunks:
+            yield {
+                'type': 'hunk',
+                'headers': hunk._hunk_headers,
+                'meta': hunk._hunk_meta,
+                'old_addr': list(hunk._old_addr),
+                'new_addr': list(hunk._new_addr),
+            }
+            for row in hunk.rows(similarity, stats, algorithm):
+                if row.kind == 'changed':
+                    old_spans, new_spans = map(_spans, row.word_diff())
                 else:
-                    # Don't need to wrap long lines; instead, a trailing '>'
-                    # char needs to be appended.
-                    wrap_marker = self._tint('>', 'wrap_marker')
-                    left = _strtrim(left, width, wrap_marker, len(right) > 0,
-                                    self._codes)
-                    right = _strtrim(right, width, wrap_marker, False,
-                                     self._codes)
-
-                    yield line_fmt % {
-                        'left_num': left_num,
-                        'left': left,
-                        'right_num': right_num,
-                        'right': right
-                    }
-
-
-def markup_to_pager(stream, opts):
-    """Pipe unified diff stream (in bytes) to pager (less)."""
+                    op = {'old': '-', 'new': '+'}.get(row.kind, '=')
+                    old_spans = [[op, row.old_text]] if row.old_num else []
+                    new_spans = [[op, row.new_text]] if row.new_num else []
+                yield {
+                    'type': 'row',
+                    'changed': row.kind != 'common',
+                    'old_num': (hunk._old_addr[0] + row.old_num - 1
+                                if row.old_num else None),
+                    'new_num': (hunk._new_addr[0] + row.new_num - 1
+                                if row.new_num else None),
+                    'old': old_spans,
+                    'new': new_spans,
+                }
+
+
+def _stat_path(old: str, new: str) -> str:
+    """Returns path of a file to show in --stat, the new one unless it is
+    /dev/null, without the 'a/' and 'b/' prefixes of git.
+    """
+    paths = [p for p in (old, new) if p != '/dev/null'] or [new]
+    if all(p[:2] in ('a/', 'b/') for p in paths):
+        paths = [p[2:] for p in paths]
+    return paths[-1]
+
+
+def _diffstat(lines):
+    """Yields (path, added, deleted) of each file of a diff stream (bytes),
+    split at the same file and hunk boundaries as DiffParser.parse().  Hunk
+    lines are counted by their first byte and never decoded, nor kept.
+    For an 'Only in' or 'Binary files' line, added is None and deleted is
+    'Only' or 'Bin' to show in place of the number of lines.
+    """
+    diff = UnifiedDiff([], None, None, [])     # for the line predicates
+    old_path = new_path = None
+    old_left = new_left = None  # lines of current hunk not seen yet
+    added = deleted = 0
+    in_hunk = False             # hunk lines may follow, no header since
+
+    for octets in lines:
+        if in_hunk and _is_hunk_line(octets):
+            lead = octets[:1]
+            if lead == b'+':
+                added += 1
+                new_left -= 1
+            elif lead == b' ':
+                old_left -= 1
+                new_left -= 1
+            elif octets.rstrip() != b'-' * 72:     # svn log separator
+                deleted += 1
+                old_left -= 1
+            else:
+                in_hunk = False
+            continue
+
+        if octets.startswith(b'--- '):
+            if old_left is None or old_left == new_left == 0:
+                if (old_path is not None and new_path is not None and
+                        old_left is not None):
+                    yield (_stat_path(old_path, new_path), added, deleted)
+                old_path, new_path = _path_of(_decode(octets)), None
+                old_left = new_left = None
+                added = deleted = 0
+                in_hunk = False
+            else:
+                deleted += 1
+                old_left -= 1
+            continue
+
+        if octets.startswith(b'+++ ') and old_path is not None:
+            if new_path is None:
+                new_path = _path_of(_decode(octets))
+            elif old_left is not None:
+                added += 1
+                new_left -= 1
+            continue
+
+        line = _decode(octets)
+        if diff.is_hunk_meta(line):
+            try:
+                old_addr, new_addr = diff.parse_hunk_meta(line)
+            except (IndexError, ValueError):
+                raise RuntimeError('invalid hunk meta: %s' % line)
+            old_left, new_left = old_addr[1], new_addr[1]
+            in_hunk = True
+
+        elif diff.is_eof(line):
+            pass
+
+        elif diff.is_only_in_dir(line) or diff.is_binary_differ(line):
+            if (old_path is not None and new_path is not None and
+                    old_left is not None):
+                yield (_stat_path(old_path, new_path), added, deleted)
+            if diff.is_only_in_dir(line):
+                path = os.path.join(*line[8:].rstrip('\r\n').split(': ', 1))
+                yield (path, None, 'Only')
+            else:
+                path = _stat_path(*re.match(
+                    '^Binary files (.*) and (.*) differ$',
+                    line.rstrip()).groups())
+                yield (path, None, 'Bin')
+            old_path = new_path = None
+            old_left = new_left = None
+            added = deleted = 0
+            in_hunk = False
+
+        else:
+            in_hunk = False     # a header
+
+    if old_path is not None and new_path is not None:
+        yield (_stat_path(old_path, new_path), added, deleted)
+
+
+def _scaled(n, width, total):
+    # As git scales the graph, a change never scales to nothing
+    return 1 + n * (width - 1) // total if n else 0
+
+
+def _format_diffstat(stats, width=80, theme=None):
+    """Returns lines of a summary of (path, added, deleted) like `git diff
+    --stat`, with the graph scaled down to fit width.  Colors of theme
+    are used when given.
+    """
+    if not stats:
+        return []
+    name_width = max(len(path) for path, _, _ in stats)
+    most = max([added + deleted for _, added, deleted in stats
+                if added is not None] or [0])
+    count_width = max([len(str(most))] +
+                      [len(note) for _, added, note in stats if added is None])
+    graph_width = max(width - name_width - count_width - 6, 10)
+
+    lines = []
+    for path, added, deleted in stats:
+        plus = minus = ''
+        if added is None:
+            count = deleted
+        else:
+            count = str(added + deleted)
+            if most > graph_width:
+                n = _scaled(added, graph_width, most)
+                m = _scaled(added + deleted, graph_width, most) - n
+            else:
+                n, m = added, deleted
+            plus, minus = '+' * n, '-' * m
+            if theme and plus:
+                plus = _colorize(plus, 'new_line', theme)
+            if theme and minus:
+                minus = _colorize(minus, 'old_line', theme)
+        line = ' %-*s | %*s %s%s' % (name_width, path, count_width, count,
+                                     plus, minus)
+        lines.append(line.rstrip() + '\n')
+
+    summary = ' %d file%s changed' % (len(stats), 's' * (len(stats) != 1))
+    insertions = sum(a for _, a, _ in stats if a is not None)
+    deletions = sum(d for _, a, d in stats if a is not None)
+    if insertions or not deletions:
+        summary += ', %d insertion%s(+)' % (insertions,
+                                            's' * (insertions != 1))
+    if deletions or not insertions:
+        summary += ', %d deletion%s(-)' % (deletions, 's' * (deletions != 1))
+    lines.append(summary + '\n')
+    return lines
+
+
+def write_diffstat(lines, opts):
+    """Write number of added and deleted lines of each file to stdout"""
+    stats = list(_diffstat(lines))
+    tty = sys.stdout.isatty()
+    theme = None
+    if opts.color == 'always' or opts.color == 'auto' and tty:
+        theme = opts.theme
+    width = _terminal_width() if tty else 80
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    for line in _format_diffstat(stats, width, theme):
+        byte_output.write(line.encode('utf-8'))
+
+
+def _write_stats(stats):
+    for key in sorted(stats):
+        sys.stderr.write('%s: %d\n' % (key, stats[key]))
+
+
+def write_records(diffs, opts):
+    """Write diffs as JSON Lines records to stdout, see _records()"""
+    stats = collections.Counter()
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    for record in _records(diffs, opts.similarity, stats,
+                           opts.diff_algorithm):
+        byte_output.write(json.dumps(record).encode('ascii') + b'\n')
+    if opts.stats:
+        _write_stats(stats)
+
+
+def _gil_enabled() -> bool:
+    """Tells if threads take turns to run Python code, i.e. it is not a
+    free-threaded build (Python 3.13+) or the GIL is turned on again.
+    """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+def _new_marker(opts, stats, marker_class=None, **kwargs):
+    """Returns a DiffMarker (or given subclass) set up by options"""
+    jobs, threads = opts.render_jobs, False
+    if opts.threads > 1 and not _gil_enabled():
+        jobs, threads = opts.threads, True
+    generated = None
+    if not opts.show_generated:
+        generated = _GENERATED_PATHS + tuple(opts.generated)
+    return (marker_class or DiffMarker)(
+        side_by_side=opts.side_by_side, width=opts.width,
+        tab_width=opts.tab_width, wrap=opts.wrap, theme=opts.theme,
+        similarity=opts.similarity, stats=stats, generated=generated,
+        algorithm=opts.diff_algorithm, jobs=jobs, threads=threads,
+        **kwargs)
+
+
+def markup_to_text(diffs, opts):
+    """Write diffs marked up without colors to stdout"""
+    stats = collections.Counter()
+    marker = _new_marker(opts, stats, color=False)
+    separator = '─' * (_terminal_width() - 1) + '\n'
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        for line in _markup_diffs(diffs, marker, separator):
+            byte_output.write(line.encode('utf-8'))
+    finally:
+        marker.close()
+    if opts.stats:
+        _write_stats(stats)
+
+
+def markup_to_html(diffs, opts):
+    """Write diffs as an HTML page to stdout"""
+    stats = collections.Counter()
+    marker = _new_marker(opts, stats, HtmlMarker)
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    head = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>ydiff</title>\n<style>\n%s</style>\n</head>\n<body>\n' %
+            _stylesheet(opts.theme, opts.tab_width))
+    byte_output.write(head.encode('utf-8'))
+    try:
+        for line in _markup_diffs(diffs, marker, '<hr class="fs">\n'):
+            byte_output.write(line.encode('utf-8'))
+    finally:
+        marker.close()
+    byte_output.write(b'</body>\n</html>\n')
+    if opts.stats:
+        _write_stats(stats)
+
+
+def _commit_cache_params(opts, args) -> tuple:
+    """Returns what a marked up log commit depends on besides its id, i.e.
+    render options and the arguments (e.g. paths) passed to the log.
+    """
+    return (opts.side_by_side, opts.width, opts.tab_width, opts.wrap,
+            opts.theme, opts.show_generated, opts.generated,
+            opts.similarity, opts.diff_algorithm, opts.grep, opts.grep_files,
+            opts.encoding, tuple(args))
+
+
+def markup_to_pager(diffs, opts, args=()):
+    """Pipe marked up diffs to pager (less), diffs are pulled lazily and
+    no more after the pager quits.  Args given to revision control are part
+    of the key of cached log commits.
+    """
     pager_cmd = [opts.pager]
     pager_opts = opts.pager_options.split(' ') if opts.pager_options else []
 
@@ -616,53 +2312,683 @@ def markup_to_pager(stream, opts):
     pager = subprocess.Popen(
         pager_cmd, stdin=subprocess.PIPE, stdout=sys.stdout)
 
-    marker = DiffMarker(side_by_side=opts.side_by_side, width=opts.width,
-                        tab_width=opts.tab_width, wrap=opts.wrap,
-                        theme=opts.theme)
-    term_width = _terminal_width()
-    diffs = DiffParser(stream).parse()
-    # Fetch one diff first, output a separation line for the rest, if any.
+    stats = collections.Counter()
+    terminal = _Terminal()
+    terminal.watch()
+    marker = _new_marker(opts, stats, terminal=terminal)
+    term_width = terminal.width()
+    separator = _colorize('─' * (term_width - 1) + '\n', 'file_separator',
+                          theme=opts.theme)
+    if opts.cache_dir:
+        params = _commit_cache_params(opts, args) + (term_width,)
+        cache = _CommitCache(opts.cache_dir, params, terminal)
+        output = cache.markup(diffs, marker, separator)
+    else:
+        output = _markup_diffs(diffs, marker, separator)
+    lines = _compact_ansi(output) if opts.compact_ansi else output
     try:
-        diff = next(diffs)
-        for line in marker.markup(diff):
-            pager.stdin.write(line.encode('utf-8'))
-    except StopIteration:
-        pass
-    for diff in diffs:
-        separator = _colorize('─' * (term_width - 1) + '\n', 'file_separator',
-                              theme=opts.theme)
-        pager.stdin.write(separator.encode('utf-8'))
-        for line in marker.markup(diff):
+        for line in lines:
+            if pager.poll() is not None:
+                break   # pager has quit, stop parsing and marking up
             pager.stdin.write(line.encode('utf-8'))
-
-    pager.stdin.close()
+        pager.stdin.close()
+    except IOError as e:
+        # Not killed by SIGPIPE when it is ignored (the case on Windows)
+        if e.errno not in [errno.EPIPE, errno.EINVAL]:
+            raise
+    finally:
+        output.close()
+        marker.close()
     pager.wait()
 
+    if opts.stats:
+        _write_stats(stats)
 
-# Keys for revision control probe, diff and log (optional) with diff
+
+def watch_workspace(args, opts, grep=None, grep_files=None):
+    """Write marked up diffs of a git workspace to the terminal and redraw
+    them whenever the workspace changes, until interrupted.
+    """
+    stats = collections.Counter()
+    terminal = _Terminal()
+    terminal.watch()
+    color = (opts.color == 'auto' and sys.stdout.isatty() or
+             opts.color == 'always')
+    marker = _new_marker(opts, stats, color=color, terminal=terminal)
+
+    def render(diffs):
+        if grep or grep_files:
+            diffs = _grep_diffs(diffs, grep, grep_files)
+        lines = (line for diff in diffs for line in marker.markup(diff))
+        if opts.compact_ansi:
+            lines = _compact_ansi(lines)
+        return ''.join(lines)
+
+    watcher = _GitWatcher(args, render, opts.jobs, opts.encoding)
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    width = None
+    try:
+        while True:
+            resized = terminal.width() != width
+            if resized:
+                width = terminal.width()
+                separator = '─' * (width - 1) + '\n'
+                if color:
+                    separator = _colorize(separator, 'file_separator',
+                                          theme=opts.theme)
+                watcher.refresh()
+            if watcher.poll() or resized:
+                # Cursor home and clear screen, then the whole text again
+                text = '\x1b[H\x1b[2J' + watcher.text(separator)
+                byte_output.write(text.encode('utf-8'))
+                byte_output.flush()
+            time.sleep(_WATCH_INTERVAL)
+    finally:
+        marker.close()
+
+
+# Keys for revision control probe, diff, log (optional) with diff and regex of
+# commit header line in the log
 _VCS_INFO = {
     'Git': {
         'probe': ['git', 'rev-parse'],
         'diff': ['git', 'diff', '--no-ext-diff', '--color=never'],
         'log': ['git', 'log', '--patch', '--color=never'],
+        'commit': r'commit ([0-9a-f]{7,64})\b',
     },
     'Mercurial': {
         'probe': ['hg', 'summary'],
         'diff': ['hg', 'diff'],
         'log': ['hg', 'log', '--patch'],
+        'commit': r'changeset: +\d+:([0-9a-f]{12,40})\b',
     },
     'Perforce': {
         'probe': ['p4', 'info'],
         'diff': ['p4', 'diff', '-du'],
         'log': None,
+        'commit': None,
     },
     'Svn': {
         'probe': ['svn', 'info'],
         'diff': ['svn', 'diff'],
         'log': ['svn', 'log', '--diff', '--use-merge-history'],
+        'commit': r'(r\d+) \| ',
     },
 }
 
+# Commit header line in log output of any revision control, the matched
+# group is commit id
+_COMMIT_RE = re.compile('|'.join(
+    '(?:%s)' % ops['commit'] for ops in _VCS_INFO.values() if ops['commit']))
+_COMMIT_BYTES_RE = re.compile(_COMMIT_RE.pattern.encode('ascii'))
+
+
+def _ordered_map(fn, items, executor, window):
+    """Like executor.map(), but submits calls lazily and keeps at most window
+    of them in flight, so a long input is not consumed ahead of the output.
+    Results are yielded in input order, each as soon as it is ready.
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _split_pathspec(args: list) -> tuple:
+    """Split args into (options and revisions, paths) the way git would, i.e.
+    at '--' when present, otherwise treat existing files as paths.
+    """
+    if '--' in args:
+        index = args.index('--')
+        return args[:index], args[index + 1:]
+    opts = [x for x in args if x.startswith('-') or not os.path.exists(x)]
+    paths = [x for x in args if x not in opts]
+    return opts, paths
+
+
+def _git_changed_blobs(args: list) -> list:
+    """Returns a list of (path tuple, blob ids) from `git diff --raw -z`, a
+    tuple has two paths (old and new) for renames and copies, otherwise one.
+    Blob ids are of the old and new side, the id of a side in the work tree
+    is all zeros.
+    """
+    cmd = _VCS_INFO['Git']['diff'] + ['--raw', '-z', '--no-abbrev'] + args
+    out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    fields = out.split(b'\0')
+    entries = []
+    i = 0
+    while i + 1 < len(fields):
+        # :<old mode> <new mode> <old id> <new id> <status>
+        meta = fields[i].split()
+        n = 2 if meta[4][:1] in (b'R', b'C') else 1
+        paths = tuple(os.fsdecode(x) for x in fields[i + 1:i + 1 + n])
+        entries.append((paths, (meta[2], meta[3])))
+        i += 1 + n
+    return entries
+
+
+def _git_changed_paths(args: list) -> list:
+    """Returns a list of path tuples of _git_changed_blobs()"""
+    return [paths for paths, _ in _git_changed_blobs(args)]
+
+
+# Read buffer size of stdin and the pipe from revision control, lines are
+# split by the C implementation of the buffered reader and come out as soon as
+# they arrive, a large buffer only saves system calls on a big diff
+_READ_BUFFER_SIZE = 1 << 20
+
+
+def _open_stdin():
+    """Returns stdin as a binary file with a large read buffer"""
+    try:
+        return open(sys.stdin.fileno(), 'rb', buffering=_READ_BUFFER_SIZE,
+                    closefd=False)
+    except (AttributeError, OSError, ValueError):
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+class _ProcessStream:
+    """Byte lines from stdout of a command.  Closing the stream also stops
+    the command if it is still running, e.g. when the pager has quit early.
+    """
+
+    def __init__(self, cmd: list):
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                      bufsize=_READ_BUFFER_SIZE)
+
+    def __iter__(self):
+        return iter(self._proc.stdout)
+
+    def close(self):
+        self._proc.stdout.close()
+        if self._proc.poll() is None:
+            self._proc.terminate()
+        self._proc.wait()
+
+
+# Magic bytes at the start of compressed input, and the function to open it
+_COMPRESSIONS = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+)
+
+# Name of a compressed patch file, read as a patch even in a workspace
+_PATCH_NAME = re.compile(r'\.(diff|patch)\.(gz|bz2|xz)$')
+
+# Bytes of compressed input decompressed at a time
+_DECOMPRESS_BLOCK_SIZE = 1 << 20
+
+
+def _compression_opener(head: bytes):
+    """Returns function to open data starting with given bytes, None if the
+    data does not look compressed.
+    """
+    for magic, opener in _COMPRESSIONS:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def _maybe_decompressed(fileobj):
+    """Returns a buffered binary file as is, or lines of its data
+    decompressed when magic bytes at its start tell it is compressed.
+    """
+    opener = _compression_opener(fileobj.peek(8))
+    return _DecompressedStream(fileobj, opener) if opener else fileobj
+
+
+def _open_compressed(path: str):
+    """Returns lines of a compressed patch file decompressed, None if the
+    file is not compressed.
+    """
+    fileobj = open(path, 'rb')
+    stream = _maybe_decompressed(fileobj)
+    if stream is fileobj:
+        fileobj.close()
+        return None
+    return stream
+
+
+class _DecompressedStream:
+    """Byte lines of compressed data in a binary file.  A background thread
+    decompresses large blocks ahead, the compression modules release the GIL
+    meanwhile, so that decompression overlaps with parsing and rendering.
+    """
+
+    def __init__(self, fileobj, opener):
+        self._fileobj = fileobj
+        self._file = opener(fileobj)
+        self._blocks = queue.Queue(maxsize=4)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+        self._thread.start()
+        self._lines = self._iter_lines()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _decompress(self):
+        end = b''   # or the error, the reader waits for one or the other
+        try:
+            while not self._closed.is_set():
+                block = self._file.read(_DECOMPRESS_BLOCK_SIZE)
+                if not block:
+                    break
+                self._put(block)
+        except Exception as e:  # e.g. zlib.error, not an OSError
+            end = e
+        finally:
+            self._put(end)
+
+    def _iter_lines(self):
+        partial = []    # pieces of a line across blocks
+        while True:
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                sys.stderr.write('*** Bad compressed input: %s\n' % block)
+                break
+            if not block:
+                break
+            # Split on LF only like reading a pipe, a CR is line content
+            start = block.find(b'\n') + 1
+            if not start:
+                partial.append(block)
+                continue
+            partial.append(block[:start])
+            yield b''.join(partial)
+            rest = io.BytesIO(block)
+            rest.seek(start)
+            lines = rest.readlines()
+            partial = []
+            if lines and not lines[-1].endswith(b'\n'):
+                partial.append(lines.pop())
+            for line in lines:
+                yield line
+        if partial:
+            yield b''.join(partial)
+
+    def __iter__(self):
+        return self._lines
+
+    def close(self):
+        self._lines.close()
+        self._closed.set()
+        self._thread.join()
+        self._file.close()
+        self._fileobj.close()
+
+
+def _git_top() -> str:
+    """Returns the path from the cwd to top of the git workspace, '' at the
+    top, paths listed by git are relative to it.
+    """
+    cmd = ['git', 'rev-parse', '--show-cdup']
+    out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    return os.fsdecode(out.strip())
+
+
+class _GitParallelStream:
+    """Byte lines of `git diff` in a git workspace, produced by one `git diff`
+    process per changed path with up to `jobs` processes running in parallel.
+    Patches come out in the order git lists the paths, the same order a
+    single `git diff` would print them.
+    """
+
+    def __init__(self, args: list, jobs: int):
+        self._opts, _ = _split_pathspec(args)
+        self._args = args
+        self._jobs = jobs
+        self._top = _git_top()
+        self._lines = self._iter_lines()
+
+    def _fetch(self, paths):
+        paths = [os.path.join(self._top, path) for path in paths]
+        cmd = _VCS_INFO['Git']['diff'] + self._opts + ['--'] + paths
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+
+    def _iter_lines(self):
+        entries = _git_changed_paths(self._args)
+        with ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            for patch in _ordered_map(self._fetch, entries, pool,
+                                      self._jobs * 2):
+                # Split on LF only like reading a pipe, a CR is line content
+                for line in io.BytesIO(patch):
+                    yield line
+
+    def __iter__(self):
+        return self._lines
+
+    def close(self):
+        self._lines.close()
+
+
+# Seconds between two polls of a workspace for --watch
+_WATCH_INTERVAL = 0.5
+
+
+class _GitWatcher:
+    """Diffs of a git workspace, each changed path rendered once and kept
+    until it changes again.  A poll lists changed paths with `git diff
+    --raw` (cheap, git checks files against stat info of the index), stats
+    the paths listed and runs `git diff` again only for the ones new to the
+    list, with other blob ids (e.g. staged again) or with another mtime or
+    size than at the last poll.
+    """
+
+    def __init__(self, args: list, render, jobs: int = 1, encoding=None):
+        self._opts, _ = _split_pathspec(args)
+        self._args = args
+        self._render = render   # returns text of a list of diffs
+        self._jobs = jobs
+        self._encoding = encoding
+        self._top = _git_top()
+        self._entries = []
+        self._stamps = {}
+        self._diffs = {}
+        self._rendered = {}
+
+    def _stamp(self, entry):
+        stamp = []
+        for path in entry:
+            try:
+                st = os.stat(os.path.join(self._top, path))
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)  # deleted
+        return tuple(stamp)
+
+    def _fetch(self, entry):
+        paths = [os.path.join(self._top, path) for path in entry]
+        cmd = _VCS_INFO['Git']['diff'] + self._opts + ['--'] + paths
+        out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+        return list(DiffParser(io.BytesIO(out), self._encoding).parse())
+
+    def poll(self) -> bool:
+        """Fetch and render diffs of paths changed since last poll, returns
+        True if the text has changed.
+        """
+        blobs = _git_changed_blobs(self._args)
+        entries = [entry for entry, _ in blobs]
+        # Blob ids tell a change in the index or of a revision, a side in the
+        # work tree has no id until added, which the stat tells instead
+        stamps = {entry: (ids, self._stamp(entry)) for entry, ids in blobs}
+        stale = [entry for entry in entries
+                 if self._stamps.get(entry) != stamps[entry]]
+        changed = bool(stale) or entries != self._entries
+        if stale:
+            with ThreadPoolExecutor(max_workers=self._jobs) as pool:
+                fetched = _ordered_map(self._fetch, stale, pool,
+                                       self._jobs * 2)
+                for entry, diffs in zip(stale, fetched):
+                    self._diffs[entry] = diffs
+                    self._rendered[entry] = self._render(diffs)
+        for entry in set(self._diffs) - set(entries):
+            del self._diffs[entry]
+            del self._rendered[entry]
+        self._entries, self._stamps = entries, stamps
+        return changed
+
+    def refresh(self):
+        """Render all diffs again, e.g. after the terminal is resized"""
+        for entry in self._entries:
+            self._rendered[entry] = self._render(self._diffs[entry])
+
+    def text(self, separator: str) -> str:
+        """Returns rendered diffs in the order git lists the paths"""
+        texts = [self._rendered[entry] for entry in self._entries]
+        return separator.join(text for text in texts if text)
+
+
+_BINARY_PROBE = 8000    # bytes looked for NUL to tell a binary file, as git
+
+
+def _file_label(path: str) -> str:
+    """Returns path line text of a file, with its mtime as `diff -u` does"""
+    mtime = time.localtime(os.stat(path).st_mtime)
+    return '%s\t%s' % (path, time.strftime('%Y-%m-%d %H:%M:%S %z', mtime))
+
+
+def _file_lines(data: bytes, encoding=None) -> list:
+    """Returns lines (split on LF only) of file content decoded with given
+    encoding, otherwise utf-8, or latin-1 if the content is not utf-8.
+    """
+    if not encoding:
+        try:
+            data.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'latin-1'
+    return [line.decode(encoding, 'replace') for line in io.BytesIO(data)]
+
+
+def _with_newline(line: str) -> str:
+    return line if line.endswith('\n') else line + '\n'
+
+
+_NO_NEWLINE = '\\ No newline at end of file\n'
+
+
+def _unified_hunks(a: list, b: list, context: int = 3,
+                   algorithm: str = 'difflib') -> list:
+    """Returns Hunk list of lines a changed to b matched by algorithm, and
+    grouped as difflib's unified_diff() groups them.  A last line without
+    newline differs from the same text with one, but in a hunk it ends with
+    a newline too and is marked as `diff -u` marks it.
+    """
+    hunks = []
+    matcher = _line_matcher(a, b, algorithm)
+    for group in matcher.get_grouped_opcodes(context):
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        # A range of no lines starts before the change, as in `diff -u`
+        old_addr = (i1 + 1 if i2 > i1 else i1, i2 - i1)
+        new_addr = (j1 + 1 if j2 > j1 else j1, j2 - j1)
+        meta = '@@ -%s +%s @@\n' % tuple(
+            '%d' % start if count == 1 else '%d,%d' % (start, count)
+            for start, count in (old_addr, new_addr))
+        hunk = Hunk([], meta, old_addr, new_addr)
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines = [(' ', line) for line in a[i1:i2]]
+            else:
+                lines = ([('-', line) for line in a[i1:i2]] +
+                         [('+', line) for line in b[j1:j2]])
+            for attr, line in lines:
+                hunk.append((attr, _with_newline(line)))
+                if not line.endswith('\n'):
+                    hunk.mark_eof(_NO_NEWLINE)
+        hunks.append(hunk)
+    return hunks
+
+
+def _error_header(e: OSError) -> str:
+    """Returns header line of an error reading a path, as `diff -r` reports
+    it before it goes on.
+    """
+    return 'diff: %s: %s\n' % (e.filename, e.strerror)
+
+
+def _compare_files(old: str, new: str, encoding=None, algorithm='difflib'):
+    """Returns UnifiedDiff of two files, or None if they are identical"""
+    try:
+        with open(old, 'rb') as f:
+            old_data = f.read()
+        with open(new, 'rb') as f:
+            new_data = f.read()
+    except OSError as e:
+        return UnifiedDiff([_error_header(e)], '', '', [])
+    if old_data == new_data:
+        return None
+    if b'\0' in old_data[:_BINARY_PROBE] or b'\0' in new_data[:_BINARY_PROBE]:
+        return UnifiedDiff(['Binary files %s and %s differ\n' % (old, new)],
+                           '', '', [])
+    hunks = _unified_hunks(_file_lines(old_data, encoding),
+                           _file_lines(new_data, encoding),
+                           algorithm=algorithm)
+    return UnifiedDiff([], '--- %s\n' % _file_label(old),
+                       '+++ %s\n' % _file_label(new), hunks)
+
+
+def _digest(path: str) -> bytes:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_BUFFER_SIZE), b''):
+            h.update(block)
+    return h.digest()
+
+
+def _file_kind(path: str) -> str:
+    if os.path.islink(path):
+        return 'symbolic link'
+    if os.path.isdir(path):
+        return 'directory'
+    return 'regular file' if os.path.isfile(path) else 'special file'
+
+
+def _walk_pairs(old: str, new: str):
+    """Yields ('pair', old file, new file) of files in both directories and
+    ('only', header line) of entries in one of them, recursively in sorted
+    order of names, the way `diff -r --no-dereference` walks.  Symbolic
+    links are compared by their targets and never followed, so a link to a
+    parent directory does not loop.  A directory which cannot be read gives
+    an ('only', error line) instead.
+    """
+    try:
+        old_names = set(os.listdir(old))
+        new_names = set(os.listdir(new))
+    except OSError as e:
+        yield 'only', _error_header(e)
+        return
+    for name in sorted(old_names | new_names):
+        if name not in new_names:
+            yield 'only', 'Only in %s: %s\n' % (old, name)
+            continue
+        if name not in old_names:
+            yield 'only', 'Only in %s: %s\n' % (new, name)
+            continue
+        old_path = os.path.join(old, name)
+        new_path = os.path.join(new, name)
+        if os.path.islink(old_path) and os.path.islink(new_path):
+            try:
+                if os.readlink(old_path) != os.readlink(new_path):
+                    yield 'only', 'Symbolic links %s and %s differ\n' % (
+                        old_path, new_path)
+            except OSError as e:
+                yield 'only', _error_header(e)
+        elif os.path.islink(old_path) or os.path.islink(new_path):
+            yield 'only', 'File %s is a %s while file %s is a %s\n' % (
+                old_path, _file_kind(old_path), new_path, _file_kind(new_path))
+        elif os.path.isdir(old_path) and os.path.isdir(new_path):
+            for entry in _walk_pairs(old_path, new_path):
+                yield entry
+        elif os.path.isfile(old_path) and os.path.isfile(new_path):
+            yield 'pair', old_path, new_path
+        else:
+            yield 'only', 'File %s is a %s while file %s is a %s\n' % (
+                old_path, _file_kind(old_path), new_path, _file_kind(new_path))
+
+
+def _compare_dirs(old: str, new: str, jobs: int = 1, encoding=None,
+                  algorithm='difflib'):
+    """Yields UnifiedDiff of files changed between two directories, and one
+    with a header line only for an entry in one of them or a binary file, as
+    DiffParser yields from `diff -ru` output.  Files of the same size and
+    mtime are taken as unchanged, files of the same size are hashed in a
+    thread pool to tell, then changed files are compared in up to `jobs`
+    threads.
+    """
+    entries = list(_walk_pairs(old, new))
+    stat_of = {}
+    for i, entry in enumerate(entries):
+        if entry[0] == 'pair':
+            try:
+                stat_of[entry[1:]] = (os.stat(entry[1]), os.stat(entry[2]))
+            except OSError as e:
+                entries[i] = ('only', _error_header(e))
+    same_size = [pair for pair, (a, b) in stat_of.items()
+                 if a.st_size == b.st_size and a.st_mtime != b.st_mtime]
+
+    def _digests(pair):
+        try:
+            return _digest(pair[0]), _digest(pair[1])
+        except OSError:
+            return None     # taken as changed, comparing tells the error
+
+    # Hashing mostly waits for reads, more threads than jobs help
+    with ThreadPoolExecutor(max_workers=max(jobs, 4)) as pool:
+        digests = dict(zip(same_size, pool.map(_digests, same_size)))
+
+    def _changed(entry):
+        if entry[0] == 'only':
+            return True
+        a, b = stat_of[entry[1:]]
+        if a.st_size != b.st_size:
+            return True
+        if a.st_mtime == b.st_mtime:
+            return False
+        pair_digests = digests[entry[1:]]
+        return pair_digests is None or pair_digests[0] != pair_digests[1]
+
+    def _compare(entry):
+        if entry[0] == 'only':
+            return UnifiedDiff([entry[1]], '', '', [])
+        return _compare_files(entry[1], entry[2], encoding, algorithm)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for diff in _ordered_map(_compare, filter(_changed, entries), pool,
+                                 jobs * 2):
+            if diff is not None:
+                yield diff
+
+
+def _comparable_paths(args: list) -> bool:
+    """Tells whether args are two files or two directories to compare"""
+    return len(args) == 2 and (all(os.path.isfile(x) for x in args) or
+                               all(os.path.isdir(x) for x in args))
+
+
+def compare_paths(old: str, new: str, jobs: int = 1, encoding=None,
+                  algorithm='difflib'):
+    """Returns a generator of UnifiedDiff of two files or two directories,
+    computed without an external diff tool.
+    """
+    if os.path.isdir(old):
+        for diff in _compare_dirs(old, new, jobs, encoding, algorithm):
+            yield diff
+        return
+    diff = _compare_files(old, new, encoding, algorithm)
+    if diff is not None:
+        yield diff
+
+
+def _diff_lines(diff):
+    """Yields lines of a diff in unified format"""
+    for line in diff._headers:
+        yield line
+    if diff._old_path:
+        yield diff._old_path
+        yield diff._new_path
+    for hunk in diff._hunks:
+        for line in hunk._hunk_headers:
+            yield line
+        yield hunk._hunk_meta
+        for i, (attr, text) in enumerate(hunk._hunk_list):
+            yield attr + text
+            if i in hunk._eof_markers:
+                yield hunk._eof_markers[i]
+
 
 def _revision_control_probe():
     """Returns version control name (key in _VCS_INFO) or None."""
@@ -697,6 +3023,27 @@ def _terminal_width():
         return 80
 
 
+class _Terminal:
+    """Width of the terminal, measured once and again after it is resized"""
+
+    def __init__(self):
+        self._width = None
+
+    def width(self):
+        if self._width is None:
+            self._width = _terminal_width()
+        return self._width
+
+    def resized(self, signum=None, frame=None):
+        """Handler of SIGWINCH"""
+        self._width = None
+
+    def watch(self):
+        """Refresh the width on SIGWINCH, where the platform has it"""
+        if hasattr(signal, 'SIGWINCH'):
+            signal.signal(signal.SIGWINCH, self.resized)
+
+
 def _trap_interrupts(entry_fn):
     def _entry_wrapper():
         signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -704,7 +3051,6 @@ def _trap_interrupts(entry_fn):
             signal.signal(signal.SIGPIPE, signal.SIG_DFL)
             return entry_fn()
 
-        import errno
         try:
             return entry_fn()
         except IOError as e:
@@ -754,6 +3100,12 @@ def _parse_args():
     parser.add_option(
         '-l', '--log', action='store_true',
         help='show log with changes from revision control')
+    parser.add_option(
+        '', '--max-commits', type='int', default=0, metavar='N',
+        help='show at most N commits of the log and stop reading it')
+    parser.add_option(
+        '', '--cache-dir', metavar='DIR',
+        help='cache marked up log commits in DIR to reuse them next time')
     parser.add_option(
         '-c', '--color', default='auto', metavar='WHEN',
         help="""colorize mode 'auto' (default), 'always', or 'never'""")
@@ -772,6 +3124,71 @@ def _parse_args():
     parser.add_option(
         '-o', '--pager-options', metavar='OPT',
         help="""options to supply to pager application""")
+    parser.add_option(
+        '-j', '--jobs', type='int', default=1, metavar='N',
+        help='in a git workspace, run N `git diff` processes in parallel, '
+             'one per changed file (default: 1, a single `git diff`); '
+             'compare N files at a time of two directories')
+    parser.add_option(
+        '', '--render-jobs', type='int', default=1, metavar='N',
+        help='render hunks of a file in N processes (default: 1), for a '
+             'huge file of many hunks')
+    parser.add_option(
+        '', '--threads', type='int', default=1, metavar='N',
+        help='render hunks of a file in N threads where Python is '
+             'free-threaded (no GIL), ignored otherwise; takes precedence '
+             'over --render-jobs')
+    parser.add_option(
+        '', '--similarity', type='float', default=0.75, metavar='R',
+        help='minimum similarity ratio (0 to 1) for a deleted and an added '
+             'line to be shown as one changed line (default: 0.75)')
+    parser.add_option(
+        '', '--diff-algorithm', type='choice', choices=list(_ALGORITHMS),
+        default='difflib', metavar='ALGO',
+        help="""algorithm to match lines, 'difflib' (default), or """
+             """'patience' or 'histogram' which anchor on unique or rare """
+             """lines to keep moved blocks of lines together""")
+    parser.add_option(
+        '', '--format', type='choice',
+        choices=['ansi', 'html', 'jsonl', 'text'], default='ansi',
+        metavar='FORMAT',
+        help="""output format 'ansi' (default) for colored text, 'text' """
+             """for the same without colors, 'html' for a page styled by """
+             """one stylesheet, or 'jsonl' for JSON Lines records of files, """
+             """hunks and aligned rows""")
+    parser.add_option(
+        '', '--stat', action='store_true',
+        help='show only the number of added and deleted lines of each file, '
+             'like `git diff --stat`')
+    parser.add_option(
+        '', '--grep', metavar='REGEX',
+        help='show only hunks with a deleted or added line matching REGEX')
+    parser.add_option(
+        '', '--grep-files', metavar='REGEX',
+        help='show only files with old or new path matching REGEX')
+    parser.add_option(
+        '', '--compact-ansi', action='store_true',
+        help='coalesce color escapes of the output to only the changes '
+             'needed, fewer bytes for the pager to read')
+    parser.add_option(
+        '', '--watch', action='store_true',
+        help='in a git workspace, show the diff and redraw it whenever a '
+             'file changes, until interrupted')
+    parser.add_option(
+        '', '--generated', action='append', default=[], metavar='GLOB',
+        help='also take files with path or name matching GLOB as generated, '
+             'may be repeated')
+    parser.add_option(
+        '', '--show-generated', action='store_true',
+        help='mark up generated files, e.g. lockfiles, minified or huge '
+             'ones, instead of a summary line for each')
+    parser.add_option(
+        '', '--encoding', metavar='ENCODING',
+        help='encoding of the diff, by default utf-8 or latin-1 detected for '
+             'each file')
+    parser.add_option(
+        '', '--stats', action='store_true',
+        help='print statistics of the diff engine to stderr on exit')
     themes = ', '.join(['default'] + sorted(_THEMES.keys() - {'default'}))
     parser.add_option(
         '', '--theme', metavar='THEME', default='default',
@@ -792,11 +3209,18 @@ def _parse_args():
     return opts, args
 
 
-def _get_patch_stream(args: list, read_vcs_log: bool):
+def _get_patch_stream(args: list, read_vcs_log: bool, jobs: int = 1):
     if not sys.stdin.isatty():
-        return getattr(sys.stdin, 'buffer', sys.stdin)
+        return _maybe_decompressed(_open_stdin())
 
     vcs = _revision_control_probe()
+    # A file in a workspace is a path to diff, unless named as a patch
+    if (not read_vcs_log and len(args) == 1 and os.path.isfile(args[0]) and
+            (vcs is None or _PATCH_NAME.search(args[0]))):
+        stream = _open_compressed(args[0])
+        if stream is not None:
+            return stream
+
     if vcs is None:
         supported_vcs = ', '.join(sorted(_VCS_INFO.keys()))
         sys.stderr.write('*** Not in a supported workspace, supported are:'
@@ -808,10 +3232,12 @@ def _get_patch_stream(args: list, read_vcs_log: bool):
         if cmd is None:
             sys.stderr.write('*** %s has no log support.\n' % vcs)
             return None
+    elif vcs == 'Git' and jobs > 1:
+        return _GitParallelStream(args, jobs)
     else:
         cmd = _VCS_INFO[vcs]['diff']
 
-    return subprocess.Popen(cmd + args, stdout=subprocess.PIPE).stdout
+    return _ProcessStream(cmd + args)
 
 
 @_trap_interrupts
@@ -821,17 +3247,67 @@ def _main():
         themes = ', '.join(['default'] + sorted(_THEMES.keys() - {'default'}))
         sys.stderr.write('*** Unknown theme, supported are: %s\n' % themes)
         return 1
-
-    stream = _get_patch_stream(args, opts.log)
-    if stream is None:
+    if not 0 <= opts.similarity <= 1:
+        sys.stderr.write('*** Similarity must be between 0 and 1\n')
+        return 1
+    if opts.encoding:
+        try:
+            codecs.lookup(opts.encoding)
+        except LookupError:
+            sys.stderr.write('*** Unknown encoding: %s\n' % opts.encoding)
+            return 1
+    try:
+        grep = opts.grep and re.compile(opts.grep)
+        grep_files = opts.grep_files and re.compile(opts.grep_files)
+    except re.error as e:
+        sys.stderr.write('*** Invalid regular expression: %s\n' % e)
         return 1
 
-    if opts.color == 'auto' and sys.stdout.isatty() or opts.color == 'always':
-        markup_to_pager(stream, opts)
+    if opts.watch:
+        if (opts.log or not sys.stdin.isatty() or
+                _revision_control_probe() != 'Git'):
+            sys.stderr.write('*** --watch needs a git workspace\n')
+            return 1
+        watch_workspace(args, opts, grep, grep_files)
+        return 0
+
+    stream = None
+    native = (not opts.log and sys.stdin.isatty() and
+              _comparable_paths(args) and _revision_control_probe() is None)
+    if native:
+        # Outside a workspace, compare two files or directories natively
+        diffs = compare_paths(args[0], args[1], opts.jobs, opts.encoding,
+                              opts.diff_algorithm)
+    else:
+        stream = _get_patch_stream(args, opts.log, opts.jobs)
+        if stream is None:
+            return 1
+        lines = stream
+        if opts.max_commits > 0:
+            lines = _limit_commits(stream, opts.max_commits)
+        diffs = DiffParser(lines, opts.encoding).parse()
+    if grep or grep_files:
+        diffs = _grep_diffs(diffs, grep, grep_files)
+    if native or grep or grep_files:
+        # No input to pipe out as is, diffs are written in unified format
+        lines = (line.encode('utf-8') for diff in diffs
+                 for line in _diff_lines(diff))
+
+    if opts.stat:
+        write_diffstat(lines, opts)
+    elif opts.format == 'jsonl':
+        write_records(diffs, opts)
+    elif opts.format == 'html':
+        markup_to_html(diffs, opts)
+    elif opts.format == 'text':
+        markup_to_text(diffs, opts)
+    elif (opts.color == 'auto' and sys.stdout.isatty() or
+          opts.color == 'always'):
+        markup_to_pager(diffs, opts, args)
     else:
         # pipe out stream untouched to make sure it is still a patch
         byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
-        for line in stream:
+        for line in lines:
             byte_output.write(line)
 
     if stream is not None: